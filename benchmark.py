@@ -0,0 +1,391 @@
+# -*- coding: utf-8 -*-
+"""Synthetic platform generator and end-to-end render benchmark.
+
+generate fills a database with a configurable platform: posts per site and
+tags per post follow a Zipf distribution, and rows go in through
+models.bulk_insert. run renders a sample of its sites, timing each generator in render.py and
+full site rebuilds, and reports throughput and peak RSS. Pass --baseline to
+fail when a generator got slower than a saved run.
+
+    python benchmark.py --sqlite bench.db generate --sites 10000 --posts 2000000
+    python benchmark.py --sqlite bench.db run --sample 20 --save bench.json
+    python benchmark.py --sqlite bench.db run --baseline bench.json
+"""
+import argparse
+import bisect
+import datetime
+import json
+import logging
+import logging.handlers
+import random
+import resource
+import time
+import unittest
+
+from peewee import SqliteDatabase
+
+import models
+import render
+import stats
+
+
+####################################################
+# Logging Boilerplate
+####################################################
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+formatter = logging.Formatter('%(asctime)15s - %(levelname)s - %(message)s')
+console_handle = logging.StreamHandler()
+console_handle.setFormatter(formatter)
+logger.addHandler(console_handle)
+LOG_FILENAME = "muchamuck_benchmark.log"
+file_handle = logging.handlers.RotatingFileHandler(
+    LOG_FILENAME, maxBytes=5 * 1024 * 1024, backupCount=5)
+file_handle = logging.FileHandler('muchamuck_benchmark.log')
+file_handle.setFormatter(formatter)
+logger.addHandler(file_handle)
+
+MODELS = models.MODELS
+
+WORDS = ("lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod "
+         "tempor incididunt ut labore et dolore magna aliqua enim ad minim veniam "
+         "quis nostrud exercitation ullamco laboris nisi aliquip ex ea commodo "
+         "consequat duis aute irure in reprehenderit voluptate velit esse cillum "
+         "fugiat nulla pariatur excepteur sint occaecat cupidatat non proident "
+         "sunt culpa qui officia deserunt mollit anim id est laborum").split()
+
+
+####################################################
+# Database
+####################################################
+
+
+def use_database(database):
+    """Binds the models to database, e.g. a SQLite stand-in for MySQL.
+
+    BaseModel is rebound too, so models.connection() opens database
+    rather than the MySQL pool.
+
+    Returns:
+            The database the models were bound to before.
+    """
+    previous = MODELS[0]._meta.database
+    for model in [models.BaseModel] + MODELS:
+        model._meta.database = database
+    stats.instrument_database(database)
+    return previous
+
+
+####################################################
+# Distributions
+####################################################
+
+
+def zipf_weights(count, exponent):
+    return [1.0 / (rank ** exponent) for rank in range(1, count + 1)]
+
+
+def zipf_counts(total, count, exponent):
+    """Splits total across count buckets, the largest first, by Zipf's law."""
+    weights = zipf_weights(count, exponent)
+    scale = float(total) / sum(weights)
+    counts = [int(weight * scale) for weight in weights]
+    for i in range(total - sum(counts)):
+        counts[i % count] += 1
+    return counts
+
+
+class ZipfSampler(object):
+    """Draws ranks 0..count-1, rank 0 the most likely."""
+
+    def __init__(self, count, exponent, rng):
+        self.rng = rng
+        self.cumulative = []
+        total = 0.0
+        for weight in zipf_weights(count, exponent):
+            total += weight
+            self.cumulative.append(total)
+
+    def sample(self):
+        return bisect.bisect(self.cumulative, self.rng.random() * self.cumulative[-1])
+
+
+####################################################
+# Dataset
+####################################################
+
+
+def generate(sites=100, posts=10000, tags=500, max_tags=5, exponent=1.1, seed=0):
+    """Generates a synthetic platform on top of whatever is in the database.
+
+    Args:
+            sites (int): Sites to create, each with its own owner and theme.
+
+            posts (int): Posts across all sites, split by Zipf's law.
+
+            tags (int): Size of the tag vocabulary.
+
+            max_tags (int): Most tags on one post; the count per post is Zipf.
+
+            exponent (float): Zipf exponent for every distribution.
+
+            seed (int): Seed, so a dataset can be generated again exactly.
+
+    Returns:
+            Dictionary of row counts inserted per model.
+    """
+    rng = random.Random(seed)
+    started = time.time()
+    password = models.password_context.encrypt("benchmark")
+    file_object = open("render_templates/dummy_theme.html", "r")
+    template = file_object.read()
+    file_object.close()
+    first_user = models.next_id(models.User)
+    first_site = models.next_id(models.Site)
+    first_post = models.next_id(models.Post)
+
+    def make_uuid():
+        return "%032x" % rng.getrandbits(128)
+
+    def user_rows():
+        for i in range(sites):
+            number = first_user + i
+            yield {"id": number, "uuid": make_uuid(), "password": password,
+                   "email": "user%d@example.com" % number,
+                   "name": "User %d" % number}
+
+    def site_rows():
+        for i in range(sites):
+            number = first_site + i
+            yield {"id": number, "uuid": make_uuid(), "owner": first_user + i,
+                   "domain": "site%d.example.com" % number, "title": "Site %d" % number,
+                   "description": " ".join(rng.sample(WORDS, 8))}
+
+    def theme_rows():
+        for i in range(sites):
+            yield {"uuid": make_uuid(), "site": first_site + i, "template": template}
+
+    counts = {"User": models.bulk_insert(models.User, user_rows()),
+              "Site": models.bulk_insert(models.Site, site_rows()),
+              "Theme": models.bulk_insert(models.Theme, theme_rows())}
+
+    post_counts = zipf_counts(posts, sites, exponent)
+    tag_sampler = ZipfSampler(tags, exponent, rng)
+    tag_count_sampler = ZipfSampler(max_tags, exponent, rng)
+    author_sampler = ZipfSampler(3, exponent, rng)
+    now = datetime.datetime.now()
+
+    def post_rows():
+        number = first_post
+        for i, post_count in enumerate(post_counts):
+            site = first_site + i
+            authors = [first_user + i] + [first_user + rng.randrange(sites) for j in range(2)]
+            for j in range(post_count):
+                post_tags_count = tag_count_sampler.sample() + 1
+                post_tags_list = sorted(set("tag%d" % tag_sampler.sample()
+                                            for k in range(post_tags_count)))
+                created_date = now - datetime.timedelta(hours=post_count - j)
+                yield {"id": number, "uuid": make_uuid(), "site": site,
+                       "author": authors[author_sampler.sample()],
+                       "title": " ".join(rng.sample(WORDS, 5)).title(),
+                       "slug": "post-%d" % number,
+                       "description": " ".join(rng.sample(WORDS, 20)),
+                       "body": " ".join(rng.choice(WORDS) for k in range(300)),
+                       "tags": post_tags_list, "created_date": created_date}
+                number += 1
+
+    counts["Post"], counts["PostTag"] = models.bulk_insert_posts(post_rows())
+    logger.info("benchmark.generate %s in %.1fs" % (json.dumps(counts, sort_keys=True),
+                                                    time.time() - started))
+    return counts
+
+
+####################################################
+# Benchmark
+####################################################
+
+
+def select_sample(sample, seed=0):
+    """The largest site plus a random spread of the rest.
+
+    Returns:
+            List of (site uuid, post count).
+    """
+    rows = list(models.Site.select(models.Site.uuid, models.fn.COUNT(models.Post.id))
+                .join(models.Post, on=models.Post.site)
+                .group_by(models.Site.id)
+                .order_by(models.fn.COUNT(models.Post.id).desc()).tuples())
+    if len(rows) <= sample:
+        return rows
+    return rows[:1] + random.Random(seed).sample(rows[1:], sample - 1)
+
+
+def site_runs(uuid):
+    """The render calls measured for one warm site, as (name, callable)."""
+    owner = models.Site.select().where(models.Site.uuid == uuid).get().owner
+    post_uuids = [post.uuid for post in models.Post.select(models.Post.uuid).join(
+        models.Site).where(models.Site.uuid == uuid).limit(100)]
+    tag_counts = models.get_site_tag_counts(uuid)
+    runs = [
+        ("generate_archives", lambda: render.generate_archives(uuid)),
+        ("generate_index", lambda: render.generate_index(uuid)),
+        ("generate_site_rss_feed", lambda: render.generate_site_rss_feed(uuid)),
+        ("generate_site_sitemap", lambda: render.generate_site_sitemap(uuid)),
+        ("generate_robot_txt", lambda: render.generate_robot_txt(uuid)),
+        ("generate_user_pages", lambda: render.generate_user_pages(uuid, owner.uuid)),
+        ("generate_post", lambda: render.generate_post(post_uuids[0])),
+        ("generate_posts", lambda: render.generate_posts(uuid, post_uuids)),
+    ]
+    if tag_counts:
+        top_tag = max(tag_counts, key=tag_counts.get)
+        runs.append(("generate_tag_pages", lambda: render.generate_tag_pages(uuid, top_tag)))
+    return runs
+
+
+def run(sample=10, seed=0):
+    """Renders the sampled sites cold with render_site, then each generator warm.
+
+    Returns:
+            Dictionary of results keyed by generator name, plus "peak_rss_kb".
+    """
+    render.build_render_workspace()
+    stats.aggregator.clear()
+    sites = select_sample(sample, seed)
+    posts = 0
+    for uuid, post_count in sites:
+        render.initialize_site(uuid)
+        render.render_site(uuid)
+        posts += post_count
+        for name, function in site_runs(uuid):
+            function()
+    results = {}
+    for (kind, name), totals in stats.aggregator.by_name.items():
+        if kind != "generator":
+            continue
+        results[name] = {
+            "calls": totals["calls"],
+            "seconds": totals["seconds"],
+            "seconds_per_call": totals["seconds"] / totals["calls"],
+            "queries_per_call": float(totals["db_queries"]) / totals["calls"],
+            "files_per_second": totals["files_written"] / max(totals["seconds"], 0.000001),
+        }
+    if "render_site" in results:
+        results["render_site"]["posts_per_second"] = (
+            posts / max(results["render_site"]["seconds"], 0.000001))
+    results["peak_rss_kb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return results
+
+
+def format_report(results):
+    lines = ["%-24s %8s %12s %10s %10s" % ("generator", "calls", "s/call", "queries", "files/s")]
+    for name in sorted(results):
+        if name == "peak_rss_kb":
+            continue
+        result = results[name]
+        lines.append("%-24s %8d %12.4f %10.1f %10.1f" % (
+            name, result["calls"], result["seconds_per_call"], result["queries_per_call"],
+            result["files_per_second"]))
+    if "render_site" in results:
+        lines.append("render_site posts/s %.1f" % results["render_site"]["posts_per_second"])
+    lines.append("peak RSS %.1f MB" % (results["peak_rss_kb"] / 1024.0))
+    return "\n".join(lines)
+
+
+def compare(results, baseline, tolerance=0.25):
+    """Lists generators slower per call, or issuing more queries per call,
+    than baseline by more than tolerance.
+    """
+    regressions = []
+    for name, result in sorted(results.items()):
+        if name == "peak_rss_kb" or name not in baseline:
+            continue
+        for key in ("seconds_per_call", "queries_per_call"):
+            before = baseline[name][key]
+            if result[key] > before * (1 + tolerance) and result[key] - before > 0.001:
+                regressions.append("%s %s %.4f -> %.4f" % (name, key, before, result[key]))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sqlite", help="SQLite file to use instead of the MySQL database")
+    parser.add_argument("--seed", type=int, default=0)
+    commands = parser.add_subparsers(dest="command")
+    generate_parser = commands.add_parser("generate", help="create a synthetic platform")
+    generate_parser.add_argument("--sites", type=int, default=100)
+    generate_parser.add_argument("--posts", type=int, default=10000)
+    generate_parser.add_argument("--tags", type=int, default=500)
+    generate_parser.add_argument("--max-tags", type=int, default=5)
+    generate_parser.add_argument("--exponent", type=float, default=1.1)
+    run_parser = commands.add_parser("run", help="time render.py against the platform")
+    run_parser.add_argument("--sample", type=int, default=10)
+    run_parser.add_argument("--save", help="write the results as JSON")
+    run_parser.add_argument("--baseline", help="fail on regressions against saved results")
+    run_parser.add_argument("--tolerance", type=float, default=0.25)
+    args = parser.parse_args(argv)
+    if args.sqlite:
+        use_database(SqliteDatabase(args.sqlite))
+    database = MODELS[0]._meta.database
+    database.connect()
+    if args.command == "generate":
+        database.create_tables(MODELS, safe=True)
+        generate(args.sites, args.posts, args.tags, args.max_tags, args.exponent, args.seed)
+        return 0
+    results = run(args.sample, args.seed)
+    print format_report(results)
+    if args.save:
+        with open(args.save, "wb") as file_object:
+            json.dump(results, file_object, indent=4, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline, "rb") as file_object:
+            regressions = compare(results, json.load(file_object), args.tolerance)
+        for regression in regressions:
+            logger.error("benchmark regression " + regression)
+        return 1 if regressions else 0
+    return 0
+
+
+####################################################
+# Tests
+####################################################
+
+
+class BenchmarkTest(unittest.TestCase):
+
+    def setUp(self):
+        render.site_cache.clear()
+        self.previous = use_database(SqliteDatabase(":memory:"))
+        MODELS[0]._meta.database.create_tables(MODELS)
+        render.build_render_workspace()
+
+    def tearDown(self):
+        render.clear_render_workspace()
+        use_database(self.previous)
+
+    def test_Zipf_Counts(self):
+        counts = zipf_counts(100, 5, 1.1)
+        self.assertEqual(sum(counts), 100)
+        self.assertEqual(counts, sorted(counts, reverse=True))
+
+    def test_Generate_And_Run(self):
+        counts = generate(sites=3, posts=40, tags=10, seed=1)
+        self.assertEqual(counts["Post"], 40)
+        self.assertEqual(models.Post.select().count(), 40)
+        self.assertEqual(models.PostTag.select().count(), counts["PostTag"])
+        results = run(sample=2)
+        self.assertIn("render_site", results)
+        self.assertIn("generate_archives", results)
+        self.assertEqual(compare(results, results), [])
+
+    def test_Use_Database(self):
+        with models.connection() as database:
+            self.assertIs(database, MODELS[0]._meta.database)
+        ((site_id, owner_id),) = models.load_dummy_data(users=1, posts_per_site=1)
+        post = models.Post.get(models.Post.site == site_id)
+        post.tags = ["a", "b"]
+        post.save()
+        self.assertEqual(models.get_post_tags(post), set(["a", "b"]))
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,469 @@
+# -*- coding: utf-8 -*-
+"""Render sites without Redis or Celery.
+
+A single-node stand-in for tasks.py. It accepts the same events, plans
+them with planner.py, and runs the render functions on a bounded pool of
+threads. Pending events and render targets are journaled to a local file,
+so a restart picks up where the last run stopped.
+
+Events are read from stdin as JSON lines, e.g. ["new_post", "<uuid>"]:
+
+    tail -f events.jsonl | python daemon.py --journal pending.jsonl --workers 4
+"""
+import argparse
+import collections
+import json
+import logging
+import logging.handlers
+import os
+import sys
+import threading
+import traceback
+import unittest
+
+import config
+import models
+import planner
+import render
+import stats
+
+
+####################################################
+# Logging Boilerplate
+####################################################
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+formatter = logging.Formatter('%(asctime)15s - %(levelname)s - %(message)s')
+console_handle = logging.StreamHandler()
+console_handle.setFormatter(formatter)
+logger.addHandler(console_handle)
+LOG_FILENAME = "muchamuck_daemon.log"
+file_handle = logging.handlers.RotatingFileHandler(
+    LOG_FILENAME, maxBytes=5 * 1024 * 1024, backupCount=5)
+file_handle = logging.FileHandler('muchamuck_daemon.log')
+file_handle.setFormatter(formatter)
+logger.addHandler(file_handle)
+
+EVENT = "event"
+TARGET = "target"
+
+POST_CHUNK_SIZE = getattr(config, "POST_CHUNK_SIZE", 100)
+
+
+####################################################
+# Events
+####################################################
+
+
+def new_post(uuid):
+    post = models.Post.select().where(models.Post.uuid == uuid).get()
+    return post.site.uuid, planner.plan_post_created(uuid, post.author.uuid, post.tags)
+
+
+def new_site(uuid):
+    render.initialize_site(uuid)
+    return uuid, planner.plan_domain_changed()
+
+
+def change_domain(uuid, new_domain):
+    site = models.Site.select().where(models.Site.uuid == uuid).get()
+    render.remove_domain_symlink(uuid)
+    site.domain = new_domain
+    site.save()
+    return uuid, planner.plan_domain_changed()
+
+
+def full_rerender(uuid):
+    render.render_site(uuid)
+    return uuid, set()
+
+
+EVENTS = {
+    "new_post": new_post,
+    "new_site": new_site,
+    "change_domain": change_domain,
+    "full_rerender": full_rerender,
+}
+"""Event name to a function returning (site uuid, planner targets)."""
+
+
+####################################################
+# Targets
+####################################################
+
+
+def render_all_posts(uuid):
+    site = models.Site.select().where(models.Site.uuid == uuid).get()
+    post_uuids = models.Post.select(models.Post.uuid).where(
+        models.Post.site == site).tuples().iterator()
+    for chunk in render.chunk_posts(post_uuids, POST_CHUNK_SIZE):
+        render.generate_posts(uuid, [post_uuid for (post_uuid,) in chunk])
+
+
+def render_all_tags(uuid):
+    for tag in models.get_site_tags(uuid):
+        render.generate_tag_pages(uuid, tag)
+
+
+def render_all_users(uuid):
+    site = models.Site.select().where(models.Site.uuid == uuid).get()
+    authors = models.User.select(models.User.uuid).join(
+        models.Post, on=models.Post.author).where(models.Post.site == site).distinct()
+    for user in authors:
+        render.generate_user_pages(uuid, user.uuid)
+
+
+TARGETS = {
+    planner.POST: lambda uuid, post_uuid: render.generate_post(post_uuid),
+    planner.UNPUBLISH: render.remove_post,
+    planner.TAG: render.generate_tag_pages,
+    planner.USER: render.generate_user_pages,
+    planner.ARCHIVE: render.generate_archives,
+    planner.INDEX: render.generate_index,
+    planner.RSS: render.generate_site_rss_feed,
+    planner.SITEMAP: render.generate_site_sitemap,
+    planner.ROBOTS: render.generate_robot_txt,
+    planner.DOMAIN: render.make_domain_symlink,
+    planner.ALL_POSTS: render_all_posts,
+    planner.ALL_TAGS: render_all_tags,
+    planner.ALL_USERS: render_all_users,
+}
+"""Planner target kind to a render function taking (site uuid, *target args)."""
+
+
+####################################################
+# Journal
+####################################################
+
+
+class Journal(object):
+    """Append-only record of pending items, replayed on start.
+
+    Each line is either {"add": id, "item": [...]} or {"done": id}. The file
+    is compacted to the pending items on open and truncated whenever the
+    daemon goes idle.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.file_object = None
+
+    def load(self):
+        items = collections.OrderedDict()
+        if not os.path.exists(self.path):
+            return items
+        with open(self.path, "rb") as file_object:
+            for line in file_object:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    logger.warning("daemon.Journal skipped a torn line in " + self.path)
+                    continue
+                if "add" in record:
+                    items[record["add"]] = record["item"]
+                else:
+                    items.pop(record["done"], None)
+        return items
+
+    def open(self, items):
+        """Rewrites the journal to hold only items, then opens it for appending."""
+        temp_path = self.path + ".tmp"
+        with open(temp_path, "wb") as file_object:
+            for item_id, item in items.items():
+                file_object.write(json.dumps({"add": item_id, "item": item}) + "\n")
+        os.rename(temp_path, self.path)
+        self.file_object = open(self.path, "ab")
+
+    def add(self, item_id, item):
+        self.write({"add": item_id, "item": item})
+
+    def done(self, item_id):
+        self.write({"done": item_id})
+
+    def write(self, record):
+        self.file_object.write(json.dumps(record) + "\n")
+        self.file_object.flush()
+
+    def truncate(self):
+        self.file_object.seek(0)
+        self.file_object.truncate()
+
+    def close(self):
+        if self.file_object:
+            self.file_object.close()
+            self.file_object = None
+
+
+####################################################
+# Daemon
+####################################################
+
+
+class RenderDaemon(object):
+    """Runs events and render targets on a bounded pool of worker threads.
+
+    Targets are kept in insertion order and deduplicated while they wait,
+    so a burst of events touching the same listing renders it once. submit
+    blocks while max_pending items are waiting, which pushes back on the
+    caller instead of growing without bound.
+    """
+
+    def __init__(self, journal_path, workers=4, max_pending=1000):
+        self.journal = Journal(journal_path)
+        self.workers = workers
+        self.max_pending = max_pending
+        self.events = collections.OrderedDict()
+        self.targets = collections.OrderedDict()
+        self.queued = {}
+        self.running = 0
+        self.next_id = 0
+        self.stopping = False
+        self.threads = []
+        self.lock = threading.Lock()
+        self.changed = threading.Condition(self.lock)
+
+    def start(self):
+        items = self.journal.load()
+        self.journal.open(items)
+        with self.lock:
+            for item_id, item in items.items():
+                self.next_id = max(self.next_id, item_id)
+                self.enqueue(item, item_id)
+        if items:
+            logger.info("daemon resumed " + str(len(items)) + " pending items")
+        for i in range(self.workers):
+            thread = threading.Thread(target=self.work, name="render-%d" % i)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def stop(self):
+        """Lets running items finish. Waiting items stay in the journal."""
+        with self.lock:
+            self.stopping = True
+            self.changed.notify_all()
+        for thread in self.threads:
+            thread.join()
+        self.journal.close()
+
+    def submit(self, event, *args, **kwargs):
+        """Queues an event. Blocks while the daemon is full.
+
+        Returns:
+                False if block=False, or timeout passed, and there was no room.
+        """
+        if event not in EVENTS:
+            raise ValueError("unknown event " + event)
+        block = kwargs.get("block", True)
+        timeout = kwargs.get("timeout")
+        with self.lock:
+            while self.pending() >= self.max_pending:
+                if not block:
+                    return False
+                self.changed.wait(timeout)
+                if timeout is not None and self.pending() >= self.max_pending:
+                    return False
+            self.enqueue([EVENT, event] + list(args))
+            return True
+
+    def join(self):
+        """Waits until nothing is queued or running."""
+        with self.lock:
+            while self.pending() or self.running:
+                self.changed.wait()
+
+    def pending(self):
+        return len(self.events) + len(self.targets)
+
+    def enqueue(self, item, item_id=None):
+        """Adds an item, journaling it unless it was replayed from the
+        journal with its item_id. Caller holds the lock.
+        """
+        if item[0] == TARGET:
+            key = (item[1], tuple(item[2]))
+            target = key[1]
+            if key in self.queued or (target[-1] is True and
+                                      (item[1], target[:-1] + (False,)) in self.queued):
+                if item_id is not None:
+                    self.journal.done(item_id)
+                return
+            if target[-1] is False:
+                covered = self.queued.pop((item[1], target[:-1] + (True,)), None)
+                if covered is not None:
+                    del self.targets[covered]
+                    self.journal.done(covered)
+        if item_id is None:
+            self.next_id += 1
+            item_id = self.next_id
+            self.journal.add(item_id, item)
+        if item[0] == TARGET:
+            self.targets[item_id] = item
+            self.queued[key] = item_id
+        else:
+            self.events[item_id] = item
+        self.changed.notify()
+
+    def take(self):
+        """Returns the next (id, item), preferring targets, or None to exit."""
+        with self.lock:
+            while not self.pending():
+                if self.stopping:
+                    return None
+                self.changed.wait()
+            if self.stopping:
+                return None
+            if self.targets:
+                item_id, item = self.targets.popitem(last=False)
+                del self.queued[(item[1], tuple(item[2]))]
+            else:
+                item_id, item = self.events.popitem(last=False)
+            self.running += 1
+            return item_id, item
+
+    def finish(self, item_id, targets=None):
+        with self.lock:
+            for uuid, target in targets or ():
+                self.enqueue([TARGET, uuid, list(target)])
+            self.journal.done(item_id)
+            self.running -= 1
+            if not self.pending() and not self.running:
+                self.journal.truncate()
+            self.changed.notify_all()
+
+    def work(self):
+        while True:
+            taken = self.take()
+            if taken is None:
+                return
+            item_id, item = taken
+            targets = None
+            try:
+                with models.connection():
+                    targets = self.run(item)
+            except Exception:
+                logger.error("daemon failed " + json.dumps(item) + "\n" + traceback.format_exc())
+            self.finish(item_id, targets)
+
+    def run(self, item):
+        """Runs one item.
+
+        Returns:
+                List of (site uuid, target) to queue next.
+        """
+        if item[0] == EVENT:
+            name, args = item[1], item[2:]
+            stats.start("task", name)
+            try:
+                uuid, targets = EVENTS[name](*args)
+            finally:
+                stats.stop()
+            return [(uuid, target) for target in sorted(planner.normalize(targets))]
+        uuid, target = item[1], item[2]
+        stats.start("task", "render_" + target[0], uuid)
+        try:
+            TARGETS[target[0]](uuid, *target[1:])
+        finally:
+            stats.stop()
+        return []
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--journal", default="muckamuck_pending.jsonl",
+                        help="file the pending queue is kept in")
+    parser.add_argument("--workers", type=int, default=4,
+                        help="render threads")
+    parser.add_argument("--max-pending", type=int, default=1000,
+                        help="queued items before reading events blocks")
+    args = parser.parse_args(argv)
+    render.build_render_workspace()
+    daemon = RenderDaemon(args.journal, args.workers, args.max_pending)
+    daemon.start()
+    try:
+        for line in iter(sys.stdin.readline, ""):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                event = json.loads(line)
+                daemon.submit(*event)
+            except (ValueError, TypeError) as error:
+                logger.error("daemon ignored " + line + ": " + str(error))
+        daemon.join()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        daemon.stop()
+        stats.flush()
+    return 0
+
+
+####################################################
+# Tests
+####################################################
+
+
+class DaemonTest(unittest.TestCase):
+
+    def setUp(self):
+        models.reset_db()
+        render.site_cache.clear()
+        render.build_render_workspace()
+        self.journal_path = os.path.join(render.MUCKAMUCK_SITES, "pending.jsonl")
+
+    def tearDown(self):
+        render.clear_render_workspace()
+
+    def test_New_Site_And_Post(self):
+        user, site, posts = render.create_dummy_data()
+        daemon = RenderDaemon(self.journal_path, workers=2)
+        daemon.start()
+        daemon.submit("new_site", site.uuid)
+        daemon.join()
+        daemon.submit("new_post", posts[0].uuid)
+        daemon.join()
+        daemon.stop()
+        self.assertTrue(os.path.isfile(render.get_site_index_path(site.uuid)))
+        self.assertTrue(os.path.isfile(render.get_post_path(site.uuid, posts[0].slug)))
+        self.assertTrue(os.path.exists(render.get_site_domain_symlink_path(site.domain)))
+        self.assertEqual(os.path.getsize(self.journal_path), 0)
+
+    def test_Resume_From_Journal(self):
+        user, site, posts = render.create_dummy_data()
+        render.initialize_site(site.uuid)
+        daemon = RenderDaemon(self.journal_path, workers=0)
+        daemon.start()
+        daemon.submit("full_rerender", site.uuid)
+        daemon.stop()
+        daemon = RenderDaemon(self.journal_path, workers=1)
+        daemon.start()
+        daemon.join()
+        daemon.stop()
+        self.assertTrue(os.path.isfile(render.get_post_path(site.uuid, posts[0].slug)))
+
+    def test_Targets_Deduplicated(self):
+        daemon = RenderDaemon(self.journal_path, workers=0)
+        daemon.start()
+        with daemon.lock:
+            daemon.enqueue([TARGET, "site", [planner.ARCHIVE, True]])
+            daemon.enqueue([TARGET, "site", [planner.INDEX]])
+            daemon.enqueue([TARGET, "site", [planner.INDEX]])
+            daemon.enqueue([TARGET, "site", [planner.ARCHIVE, False]])
+            daemon.enqueue([TARGET, "site", [planner.ARCHIVE, True]])
+        self.assertEqual(list(daemon.targets.values()), [
+            [TARGET, "site", [planner.INDEX]], [TARGET, "site", [planner.ARCHIVE, False]]])
+        daemon.stop()
+        daemon = RenderDaemon(self.journal_path, workers=0)
+        self.assertEqual(len(daemon.journal.load()), 2)
+
+    def test_Backpressure(self):
+        daemon = RenderDaemon(self.journal_path, workers=0, max_pending=1)
+        daemon.start()
+        self.assertTrue(daemon.submit("full_rerender", "site"))
+        self.assertFalse(daemon.submit("full_rerender", "site", block=False))
+        self.assertFalse(daemon.submit("full_rerender", "site", timeout=0.01))
+        daemon.stop()
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -2,3 +2,26 @@ PAGE_ITEM_LIMIT = 10
 RSS_ITEM_LIMIT = 10
 
 OUTPUT_DIRECTORY = ""
+
+TEMPLATE_CACHE_SIZE = 128
+# Number listing pages from the oldest post so publishing only touches the
+# newest page. Themes get newest_page to tell which way pages run.
+STABLE_PAGINATION = False
+# URLs per sitemap-N.xml.gz chunk; the sitemaps.org limit is 50,000.
+SITEMAP_URL_LIMIT = 50000
+# Rendered RSS <item> fragments kept per worker process.
+RSS_ITEM_CACHE_SIZE = 4096
+# Post pages per render_posts task when a whole site's posts are rendered.
+POST_CHUNK_SIZE = 100
+# Seconds a site's listing renders wait for more events before running.
+COALESCE_WINDOW = 5
+# Where each worker process writes muckamuck_<pid>.prom, and how often.
+STATS_DIRECTORY = "."
+STATS_FLUSH_INTERVAL = 60
+# How long a running render claims its target, and how long a completed
+# render version is remembered so duplicate or redelivered tasks skip it.
+DEDUP_CLAIM_TIMEOUT = 600
+DEDUP_TTL = 3600
+# How many sites each process keeps cached, and for how many seconds.
+SITE_CACHE_SIZE = 1024
+SITE_CACHE_TTL = 60
@@ -0,0 +1,350 @@
+# -*- coding: utf-8 -*-
+"""Schema migrations for existing databases.
+
+create_tables only creates the indexes a model declares when the table
+is first made, so databases created before an index was added never get
+it. migrate adds every index in INDEXES that a table is missing, using
+peewee's playhouse.migrate, and is safe to run again. It also rebuilds a
+tag index keyed by post uuid, from before PostTag referenced posts by id.
+
+check renders one site and EXPLAINs every query its generators ran. It
+reports full table scans and sorts that could not be read from an index.
+Run it against a production-sized copy, because small tables are often
+scanned even when an index exists.
+
+    python migrations.py migrate
+    python migrations.py check <site uuid>
+"""
+import argparse
+import contextlib
+import logging
+import logging.handlers
+import re
+import unittest
+
+from peewee import SqliteDatabase
+from playhouse.migrate import SchemaMigrator, migrate as run_operations
+
+import models
+import render
+
+
+####################################################
+# Logging Boilerplate
+####################################################
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+formatter = logging.Formatter('%(asctime)15s - %(levelname)s - %(message)s')
+console_handle = logging.StreamHandler()
+console_handle.setFormatter(formatter)
+logger.addHandler(console_handle)
+LOG_FILENAME = "muchamuck_migrations.log"
+file_handle = logging.handlers.RotatingFileHandler(
+    LOG_FILENAME, maxBytes=5 * 1024 * 1024, backupCount=5)
+file_handle = logging.FileHandler('muchamuck_migrations.log')
+file_handle.setFormatter(formatter)
+logger.addHandler(file_handle)
+
+# (model, field names, unique). Listings filter on site, user pages also on
+# author and tag pages on tag, and all order by created_date then post id.
+# InnoDB and SQLite append the primary key to every secondary index, so the
+# post indexes cover the id tiebreak; the tag index carries the post id. The
+# models declare the same indexes for new databases.
+INDEXES = (
+    (models.Post, ("site", "created_date"), False),
+    (models.Post, ("site", "author", "created_date"), False),
+    (models.PostTag, ("site", "tag", "created_date", "post"), False),
+    (models.PostTag, ("post", "tag"), True),
+)
+
+LISTING_INDEXES = INDEXES[:3]
+"""The INDEXES the listing generators' queries should be planned with."""
+
+SUPERSEDED_INDEXES = (
+    (models.PostTag, ("site", "tag", "created_date")),
+)
+"""(model, field names) of indexes an INDEXES entry now extends, dropped by
+migrate."""
+
+
+####################################################
+# Indexes
+####################################################
+
+
+def get_database():
+    return models.Post._meta.database
+
+
+def get_columns(model, fields):
+    return [model._meta.fields[name].db_column for name in fields]
+
+
+def find_index(database, model, fields, exact=False):
+    """Names an existing index on model that starts with fields' columns,
+    or with exact, has just those columns.
+
+    Returns:
+            The index name, or None.
+    """
+    columns = get_columns(model, fields)
+    for index in database.get_indexes(model._meta.db_table):
+        index_columns = list(index.columns)
+        if (index_columns == columns if exact else index_columns[:len(columns)] == columns):
+            return index.name
+    return None
+
+
+def missing_indexes(database):
+    """Lists the INDEXES no existing index on the table starts with.
+
+    Returns:
+            List of (table, columns, unique).
+    """
+    return [(model._meta.db_table, get_columns(model, fields), unique)
+            for model, fields, unique in INDEXES
+            if find_index(database, model, fields) is None]
+
+
+def migrate_post_tags(database):
+    """Rebuilds the tag index from the posts if it still keys posts by uuid.
+
+    The tag index only copies the posts' tags, so it is dropped and refilled
+    rather than altered in place.
+
+    Returns:
+            True if the tag index was rebuilt.
+    """
+    table = models.PostTag._meta.db_table
+    columns = [column.name for column in database.get_columns(table)]
+    if models.PostTag.post.db_column in columns:
+        return False
+    logger.info("rebuilding %s keyed by post id" % table)
+    database.drop_table(models.PostTag)
+    database.create_table(models.PostTag)
+    posts = models.Post.select(models.Post.id, models.Post.site, models.Post.tags,
+                               models.Post.created_date).iterator()
+    models.bulk_insert(models.PostTag, (
+        {"site": post.site_id, "tag": tag, "post": post.id, "created_date": post.created_date}
+        for post in posts for tag in set(post.tags)))
+    return True
+
+
+def migrate(database=None):
+    """Rebuilds a uuid keyed tag index and adds the missing INDEXES.
+
+    Returns:
+            List of (table, columns, unique) that were added.
+    """
+    database = database or get_database()
+    migrate_post_tags(database)
+    missing = missing_indexes(database)
+    migrator = SchemaMigrator.from_database(database)
+    for table, columns, unique in missing:
+        logger.info("adding index on %s (%s)" % (table, ", ".join(columns)))
+        run_operations(migrator.add_index(table, columns, unique))
+    for model, fields in SUPERSEDED_INDEXES:
+        name = find_index(database, model, fields, exact=True)
+        if name is not None:
+            logger.info("dropping superseded index %s" % name)
+            run_operations(migrator.drop_index(model._meta.db_table, name))
+    return missing
+
+
+####################################################
+# Query Plans
+####################################################
+
+
+@contextlib.contextmanager
+def captured_queries(database):
+    """Collects the (sql, params) of every SELECT run inside the block."""
+    queries = []
+    execute_sql = database.execute_sql
+
+    def capturing_execute_sql(sql, params=None, *args, **kwargs):
+        if sql.lstrip().upper().startswith("SELECT"):
+            queries.append((sql, params or ()))
+        return execute_sql(sql, params, *args, **kwargs)
+    database.execute_sql = capturing_execute_sql
+    try:
+        yield queries
+    finally:
+        database.execute_sql = execute_sql
+
+
+def explain(database, sql, params):
+    """EXPLAINs one query.
+
+    Returns:
+            (problems, indexes). problems is a list of short descriptions of
+            full table scans and sorts the query could not read from an
+            index. indexes is the set of index names the plan uses or, on
+            MySQL, lists as possible keys.
+    """
+    problems = []
+    indexes = set()
+    if isinstance(database, SqliteDatabase):
+        cursor = database.execute_sql("EXPLAIN QUERY PLAN " + sql, params)
+        for row in cursor.fetchall():
+            detail = row[-1]
+            indexes.update(re.findall(r"USING (?:COVERING )?INDEX (\w+)", detail))
+            if re.match(r"SCAN (TABLE )?\w+$", detail):
+                problems.append("full scan: " + detail)
+            elif "TEMP B-TREE" in detail:
+                problems.append("sort: " + detail)
+        return problems, indexes
+    cursor = database.execute_sql("EXPLAIN " + sql, params)
+    names = [column[0].lower() for column in cursor.description]
+    for row in cursor.fetchall():
+        row = dict(zip(names, row))
+        for keys in (row.get("key"), row.get("possible_keys")):
+            indexes.update(key for key in (keys or "").split(",") if key)
+        if row.get("type") == "ALL":
+            problems.append("full scan: %s" % row.get("table"))
+        if "filesort" in (row.get("extra") or ""):
+            problems.append("sort: %s uses a filesort" % row.get("table"))
+    return problems, indexes
+
+
+def get_generator_calls(site_uuid):
+    """Picks a user, post and tag of the site to run each listing generator with.
+
+    Returns:
+            List of (generator name, call).
+    """
+    site = render.get_site(site_uuid)
+    user = site.owner
+    post = models.Post.select().where(models.Post.site == site).order_by(
+        models.Post.created_date.desc()).get()
+    tag_counts = models.get_site_tag_counts(site_uuid)
+    calls = [
+        ("generate_archives", lambda: render.generate_archives(site_uuid)),
+        ("generate_archives", lambda: render.generate_archives(site_uuid, page=2)),
+        ("generate_index", lambda: render.generate_index(site_uuid)),
+        ("generate_post", lambda: render.generate_post(post.uuid)),
+        ("generate_site_rss_feed", lambda: render.generate_site_rss_feed(site_uuid)),
+        ("generate_site_sitemap", lambda: render.generate_site_sitemap(site_uuid)),
+        ("generate_user_pages", lambda: render.generate_user_pages(site_uuid, user.uuid)),
+    ]
+    if tag_counts:
+        tag = max(tag_counts, key=tag_counts.get)
+        calls.append(("generate_tag_pages", lambda: render.generate_tag_pages(site_uuid, tag)))
+        calls.append(("generate_tag_pages",
+                      lambda: render.generate_tag_pages(site_uuid, tag, page=1)))
+    return calls
+
+
+def explain_generators(site_uuid, database=None):
+    """Renders a site and EXPLAINs every distinct query each generator ran.
+
+    Returns:
+            List of (generator name, sql, problems, indexes), as explain
+            returns them.
+    """
+    database = database or get_database()
+    render.initialize_site(site_uuid)
+    results = []
+    for name, call in get_generator_calls(site_uuid):
+        render.site_cache.clear()
+        with captured_queries(database) as queries:
+            call()
+        seen = set()
+        for sql, params in queries:
+            if sql in seen:
+                continue
+            seen.add(sql)
+            problems, indexes = explain(database, sql, params)
+            results.append((name, sql, problems, indexes))
+    return results
+
+
+def check_indexes(site_uuid, database=None):
+    """Lists the generator queries that did not use an index.
+
+    Returns:
+            List of (generator name, sql, problems).
+    """
+    return [(name, sql, problems) for name, sql, problems, indexes
+            in explain_generators(site_uuid, database) if problems]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    commands = parser.add_subparsers(dest="command")
+    commands.add_parser("migrate", help="add missing indexes")
+    check_parser = commands.add_parser("check", help="EXPLAIN a site's render queries")
+    check_parser.add_argument("site_uuid")
+    args = parser.parse_args(argv)
+    with models.connection():
+        if args.command == "migrate":
+            migrate()
+            return 0
+        results = check_indexes(args.site_uuid)
+    for name, sql, problems in results:
+        logger.error("%s: %s\n    %s" % (name, "; ".join(problems), sql))
+    return 1 if results else 0
+
+
+####################################################
+# Tests
+####################################################
+
+
+class MigrationsTest(unittest.TestCase):
+
+    def setUp(self):
+        models.reset_db()
+        render.site_cache.clear()
+        render.build_render_workspace()
+
+    def tearDown(self):
+        render.clear_render_workspace()
+
+    def drop_indexes(self, database):
+        """Takes the database back to before the models declared INDEXES."""
+        migrator = SchemaMigrator.from_database(database)
+        for model, fields, unique in INDEXES:
+            name = find_index(database, model, fields)
+            run_operations(migrator.drop_index(model._meta.db_table, name))
+
+    def test_Migrate_Twice(self):
+        database = get_database()
+        self.drop_indexes(database)
+        migrator = SchemaMigrator.from_database(database)
+        for model, fields in SUPERSEDED_INDEXES:
+            run_operations(migrator.add_index(
+                model._meta.db_table, get_columns(model, fields), False))
+        self.assertEqual(len(migrate(database)), len(INDEXES))
+        self.assertEqual(missing_indexes(database), [])
+        for model, fields in SUPERSEDED_INDEXES:
+            self.assertIsNone(find_index(database, model, fields, exact=True))
+        self.assertEqual(migrate(database), [])
+
+    def test_Migrate_Post_Uuid_Tags(self):
+        user, site, posts = render.create_dummy_data()
+        database = get_database()
+        table = models.PostTag._meta.db_table
+        database.drop_table(models.PostTag)
+        database.execute_sql(
+            "CREATE TABLE %s (id INTEGER NOT NULL PRIMARY KEY, site_id INTEGER NOT NULL, "
+            "tag VARCHAR(255) NOT NULL, post_uuid VARCHAR(255) NOT NULL, "
+            "created_date DATETIME NOT NULL)" % table)
+        migrate(database)
+        self.assertFalse(migrate_post_tags(database))
+        for post in posts:
+            self.assertEqual(models.get_post_tags(post), set(post.tags))
+
+    def test_Generators_Use_Indexes(self):
+        user, site, posts = render.create_dummy_data()
+        database = get_database()
+        used = set()
+        for name, sql, problems, indexes in explain_generators(site.uuid, database):
+            used.update(indexes)
+            self.assertEqual(problems, [], "%s: %s" % (name, sql))
+        for model, fields, unique in LISTING_INDEXES:
+            self.assertIn(find_index(database, model, fields), used)
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
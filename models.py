@@ -2,12 +2,18 @@
 """All the models for muckamuchk
 """
 
+import contextlib
 import datetime
 import json
-
+from multiprocessing.pool import ThreadPool
 import os
+import random
+import threading
+
+from passlib.context import CryptContext
 from passlib.hash import bcrypt
 from peewee import *
+from playhouse.pool import PooledMySQLDatabase
 import unittest
 
 import utilities
@@ -47,17 +53,99 @@ OUTPUT_PATHS['site_id'] = os.path.join(OUTPUT_PATHS['site'], "id")
 # Database Connection
 ####################################################
 
-db = MySQLDatabase(os.environ['MUCKAMUCK_DB_NAME'], host=os.environ['MUCKAMUCK_DB_HOST'], user=os.environ[
-                                     'MUCKAMUCK_DB_USER_NAME'], password=os.environ['MUCKAMUCK_DB_USER_PASSWORD'])
-"""Initialize database connection with database connection values from env variables
+class RecyclingPooledMySQLDatabase(PooledMySQLDatabase):
+    """Pooled MySQL connections that are health checked and recycled.
+
+    On checkout each pooled connection is pinged, and it is replaced once it
+    has been checked out max_uses times or is older than stale_timeout
+    seconds.
+    """
+
+    def __init__(self, database, max_uses=None, **kwargs):
+        self.max_uses = max_uses
+        self._uses = {}
+        super(RecyclingPooledMySQLDatabase, self).__init__(database, **kwargs)
+
+    def _connect(self, *args, **kwargs):
+        conn = super(RecyclingPooledMySQLDatabase, self)._connect(*args, **kwargs)
+        key = self.conn_key(conn)
+        self._uses[key] = self._uses.get(key, 0) + 1
+        return conn
+
+    def _is_closed(self, key, conn):
+        if super(RecyclingPooledMySQLDatabase, self)._is_closed(key, conn):
+            self._uses.pop(key, None)
+            return True
+        if self.max_uses and self._uses.get(key, 0) >= self.max_uses:
+            self._close(conn, close_conn=True)
+            return True
+        try:
+            conn.ping()
+        except Exception:
+            self._close(conn, close_conn=True)
+            return True
+        return False
+
+    def _close(self, conn, close_conn=False):
+        if close_conn:
+            self._uses.pop(self.conn_key(conn), None)
+        super(RecyclingPooledMySQLDatabase, self)._close(conn, close_conn)
+
+    def reset_after_fork(self):
+        """Forgets connections inherited from a parent process without
+        closing them, since the parent still owns their sockets.
+
+        The forking thread's open connection and the connection lock are
+        replaced too, as the parent may have held either at fork time.
+        """
+        self._connections = []
+        self._in_use = {}
+        self._closed = set()
+        self._uses = {}
+        self._Database__local = type(self._Database__local)()
+        self._conn_lock = threading.Lock()
+
+
+db = RecyclingPooledMySQLDatabase(
+    os.environ['MUCKAMUCK_DB_NAME'], host=os.environ['MUCKAMUCK_DB_HOST'],
+    user=os.environ['MUCKAMUCK_DB_USER_NAME'], password=os.environ['MUCKAMUCK_DB_USER_PASSWORD'],
+    max_connections=int(os.environ.get('MUCKAMUCK_DB_MAX_CONNECTIONS', 8)),
+    stale_timeout=int(os.environ.get('MUCKAMUCK_DB_STALE_TIMEOUT', 300)),
+    max_uses=int(os.environ.get('MUCKAMUCK_DB_MAX_USES', 1000)))
+"""Initialize pooled database connection with database connection values from env variables
 """
 
 
+@contextlib.contextmanager
+def connection():
+    """Holds a pooled connection for the block.
+
+    A connection the thread already holds, such as a parent task's when
+    Celery runs subtasks eagerly, is reused and left open. The database is
+    the one the models are bound to, normally db.
+    """
+    database = BaseModel._meta.database
+    if not database.is_closed():
+        yield database
+        return
+    database.connect()
+    try:
+        yield database
+    finally:
+        database.close()
+
+
 ####################################################
 # Base Model
 ####################################################
 
 
+save_listeners = []
+"""Callables run with each model instance after it is saved, e.g. to drop
+cached copies. Bulk inserts do not trigger them.
+"""
+
+
 class BaseModel(Model):
         """This is the base model class that all other models inherit
         """
@@ -66,6 +154,40 @@ class BaseModel(Model):
                 """
                 database = db
 
+        def save(self, *args, **kwargs):
+                result = super(BaseModel, self).save(*args, **kwargs)
+                for listener in save_listeners:
+                        listener(self)
+                return result
+
+
+####################################################
+# Passwords
+####################################################
+BCRYPT_ROUNDS = int(os.environ.get('MUCKAMUCK_BCRYPT_ROUNDS', bcrypt.default_rounds))
+"""bcrypt work factor. Each step doubles the cost of a login. Test suites
+can set MUCKAMUCK_BCRYPT_ROUNDS=4, bcrypt's minimum, to make hashing cheap.
+"""
+
+password_context = CryptContext(
+    schemes=["bcrypt"], bcrypt__default_rounds=BCRYPT_ROUNDS,
+    bcrypt__min_rounds=BCRYPT_ROUNDS)
+"""Hashes below BCRYPT_ROUNDS are flagged for rehashing on the next login."""
+
+PASSWORD_THREADS = int(os.environ.get('MUCKAMUCK_PASSWORD_THREADS', 4))
+
+_password_pool = None
+_password_pool_lock = threading.Lock()
+
+
+def get_password_pool():
+    """The thread pool passwords are verified on, started on first use."""
+    global _password_pool
+    with _password_pool_lock:
+        if _password_pool is None:
+            _password_pool = ThreadPool(PASSWORD_THREADS)
+        return _password_pool
+
 
 ####################################################
 # User Model
@@ -111,6 +233,10 @@ class User(BaseModel):
     uuid = CharField(index=True)
 
 
+    @property
+    def public_name(self):
+            return self.name
+
     @property
     def json_path(self):
             path = os.path.join(utilities.get_output_json_path(), "user", self.uuid)
@@ -136,18 +262,39 @@ class User(BaseModel):
         Args:
                 password (str): The plain text password entered by human
         """
-        self.password = bcrypt.encrypt(password)
+        self.password = password_context.encrypt(password)
 
     def verify_password(self, password):
         """Validated a submitted password.
 
+        Note:
+                A correct password stored with fewer than BCRYPT_ROUNDS is
+                rehashed and saved.
+
         Args:
                 password (str): The plain text password entered by human
 
         Returns:
                 True if successful, False otherwise.
         """
-        return bcrypt.verify(password, self.password)
+        valid, new_password = password_context.verify_and_update(password, self.password)
+        if valid and new_password:
+            self.password = new_password
+            if self.id is not None:
+                with connection():
+                    self.save(only=[User.password])
+        return valid
+
+    def verify_password_async(self, password):
+        """Runs verify_password on the password thread pool.
+
+        bcrypt releases the GIL while hashing, so the caller's thread is not
+        blocked.
+
+        Returns:
+                multiprocessing.pool.AsyncResult; get() returns the result.
+        """
+        return get_password_pool().apply_async(self.verify_password, (password,))
 
     def to_dict(self):
         """Creats dictionary with private info redacted.
@@ -162,9 +309,9 @@ class User(BaseModel):
         userDict["name"] = self.name
         userDict["uuid"] = self.uuid
         userDict["bio"] = self.bio
-        userDict["twitter"] = self.twitterID
-        userDict["facebook"] = self.facebookID
-        userDict["google"] = self.googleID
+        userDict["twitter"] = self.twitter
+        userDict["facebook"] = self.facebook
+        userDict["google"] = self.google
         return userDict
 
     def make_dir(self):
@@ -205,9 +352,9 @@ def create_dummy_user():
     user.name = utilities.fake.name()
     user.public_email = utilities.fake.free_email()
     user.bio = utilities.fake.text()
-    user.twitterID = utilities.generate_UUID()
-    user.facebookID = utilities.generate_UUID()
-    user.googleID = utilities.generate_UUID()
+    user.twitter = utilities.generate_UUID()
+    user.facebook = utilities.generate_UUID()
+    user.google = utilities.generate_UUID()
     return user
 
 
@@ -298,18 +445,447 @@ class Site(BaseModel):
         file_object.close()
 
 
-def create_dummy_site():
+def create_dummy_site(owner=None):
     """Generats a utilities.fake site.
 
+    Args:
+        owner (User): Saved owner of the site. A new dummy user by default.
+
     Yields:
         Site: One utilities.fake site.
     """
-    user = create_dummy_user()
-    user.save()
+    if owner is None:
+        owner = create_dummy_user()
+        owner.save()
     site = Site()
     site.description = utilities.fake.text(max_nb_chars=200)
-    site.domain = utilities.fake.domain_name()
-    site.owner = user
+    site.domain = utilities.generate_UUID().lower() + "." + utilities.fake.domain_name()
+    site.owner = owner
     site.title = utilities.fake.sentence(nb_words=6, variable_nb_words=True)
     site.uuid = utilities.generate_UUID()
     return site
+
+
+def get_random_site():
+    """Picks a site at random.
+    """
+    query = Site.select().order_by(Site.id)
+    return query.offset(random.randrange(query.count())).limit(1).get()
+
+
+####################################################
+# Theme Model
+####################################################
+class Theme(BaseModel):
+    """This is the Theme model.
+
+    Attributes:
+            created_date (datetime): When theme was created.
+
+            site (Site): Site the theme belongs to. One theme per site.
+
+            template (str): Jinja2 template every page of the site is rendered with.
+
+            uuid (str): A universally unique identifier assigned to theme.
+
+
+    """
+    created_date = DateTimeField(default=datetime.datetime.now)
+    site = ForeignKeyField(Site, unique=True)
+    template = TextField()
+    uuid = CharField(index=True)
+
+
+def get_dummy_template():
+    file_object = open("render_templates/dummy_theme.html", "r")
+    template = file_object.read()
+    file_object.close()
+    return template
+
+
+def create_dummy_theme(site):
+    """Generats the dummy theme for a site.
+
+    Yields:
+        Theme: One dummy theme.
+    """
+    theme = Theme()
+    theme.uuid = utilities.generate_UUID()
+    theme.site = site
+    theme.template = get_dummy_template()
+    return theme
+
+
+####################################################
+# Post Model
+####################################################
+class TagListField(TextField):
+    """A list of tags stored as a JSON array, since MySQL has no array column.
+    """
+
+    def db_value(self, value):
+        return json.dumps(list(value or []))
+
+    def python_value(self, value):
+        return json.loads(value) if value else []
+
+
+class Post(BaseModel):
+    """This is the Post model.
+
+    Attributes:
+            author (User): User that wrote the post.
+
+            body (str): Post body.
+
+            created_date (datetime): When post was created.
+
+            description (str): Post summary.
+
+            site (Site): Site the post is published on.
+
+            slug (str): URL name of the post, unique per site.
+
+            tags (list): The post's tags, also indexed in PostTag when the
+            post is saved.
+
+            title (str): Post title.
+
+            uuid (str): A universally unique identifier assigned to post.
+
+
+    """
+    author = ForeignKeyField(User)
+    body = TextField()
+    created_date = DateTimeField(default=datetime.datetime.now)
+    description = CharField(default="")
+    site = ForeignKeyField(Site)
+    slug = CharField()
+    tags = TagListField(default=list)
+    title = CharField()
+    uuid = CharField(index=True)
+
+    class Meta:
+        indexes = (
+            (('site', 'slug'), True),
+            (('site', 'created_date'), False),
+            (('site', 'author', 'created_date'), False),
+        )
+
+    def save(self, *args, **kwargs):
+        """Saves the post and its tag index rows in one transaction.
+        """
+        with self._meta.database.transaction():
+            result = super(Post, self).save(*args, **kwargs)
+            set_post_tags(self)
+        return result
+
+    def delete_instance(self, *args, **kwargs):
+        """Deletes the post and its tag index rows in one transaction.
+        """
+        with self._meta.database.transaction():
+            remove_post_tags(self)
+            return super(Post, self).delete_instance(*args, **kwargs)
+
+    def to_dict(self):
+        """Creats dictionary for rendering.
+
+        Returns:
+                Dictionary
+        """
+        postDict = {}
+        postDict["created_date"] = self.created_date.isoformat()
+        postDict["author"] = self.author.to_dict()
+        postDict["body"] = self.body
+        postDict["description"] = self.description
+        postDict["site"] = self.site.to_dict()
+        postDict["slug"] = self.slug
+        postDict["tags"] = self.tags
+        postDict["title"] = self.title
+        postDict["uuid"] = self.uuid
+        return postDict
+
+    def dummy(self, site, author):
+        """Fills the post with utilities.fake content.
+        """
+        self.uuid = utilities.generate_UUID()
+        self.author = author
+        self.body = utilities.fake.paragraph(nb_sentences=15)
+        self.description = utilities.fake.text(max_nb_chars=200)
+        self.site = site
+        self.title = utilities.fake.sentence(nb_words=4)
+        self.slug = utilities.fake.slug(self.title) + "-" + self.uuid.lower()
+        self.tags = utilities.fake.words(nb=3) + ["tag"]
+
+
+def get_random_post_from_site(site_uuid):
+    """Picks one post of a site at random.
+    """
+    query = Post.select().join(Site).where(Site.uuid == site_uuid).order_by(Post.id)
+    return query.offset(random.randrange(query.count())).limit(1).get()
+
+
+####################################################
+# Tag Index
+####################################################
+class PostTag(BaseModel):
+    """One row per tag on a post, kept current by Post.save and
+    Post.delete_instance.
+
+    Replaces scanning every post's tag array. The post's created_date is
+    copied in so per-tag listings can be read in (created_date, post id)
+    order from the index.
+
+    Attributes:
+            site (Site): Site the post belongs to.
+
+            tag (str): The tag.
+
+            post (Post): The tagged post.
+
+            created_date (datetime): When the tagged post was created.
+
+
+    """
+    site = ForeignKeyField(Site)
+    tag = CharField()
+    post = ForeignKeyField(Post)
+    created_date = DateTimeField()
+
+    class Meta:
+        indexes = (
+            (('site', 'tag', 'created_date', 'post'), False),
+            (('post', 'tag'), True),
+        )
+
+
+def set_post_tags(post):
+    """Replaces the indexed tags of a saved post with its current tags.
+
+    Args:
+            post (Post): The post.
+    """
+    rows = [{"site": post.site_id, "tag": tag, "post": post.id,
+             "created_date": post.created_date} for tag in set(post.tags)]
+    with PostTag._meta.database.transaction():
+        PostTag.delete().where(PostTag.post == post.id).execute()
+        if rows:
+            PostTag.insert_many(rows).execute()
+
+
+def remove_post_tags(post):
+    """Drops a post from the tag index.
+    """
+    PostTag.delete().where(PostTag.post == post.id).execute()
+
+
+def get_post_tags(post):
+    """Looks up the indexed tags of a post.
+
+    Returns:
+            Set of tags.
+    """
+    return set(row.tag for row in PostTag.select(PostTag.tag).where(
+        PostTag.post == post.id))
+
+
+def get_site_tags(uuid):
+    """Lists every tag used on a site.
+
+    Returns:
+            Set of tags.
+    """
+    query = PostTag.select(PostTag.tag).join(Site).where(
+        Site.uuid == uuid).distinct()
+    return set(row.tag for row in query)
+
+
+def get_site_tag_counts(uuid):
+    """Counts the posts carrying each tag on a site.
+
+    Returns:
+            Dictionary of tag to post count.
+    """
+    query = PostTag.select(PostTag.tag, fn.COUNT(PostTag.id).alias("count")).join(
+        Site).where(Site.uuid == uuid).group_by(PostTag.tag)
+    return dict((row.tag, row.count) for row in query)
+
+
+####################################################
+# Bulk Fixtures
+####################################################
+BULK_BATCH_SIZE = 500
+"""Rows per insert_many. SQLite allows 999 variables per statement, so
+batches shrink to fit there.
+"""
+
+
+def bulk_insert(model, rows, batch_size=BULK_BATCH_SIZE):
+    """Inserts an iterable of row dictionaries with insert_many.
+
+    Rows are read lazily and each batch is one transaction, so a generator
+    of any length can be loaded in constant memory.
+
+    Returns:
+            Number of rows inserted.
+    """
+    database = model._meta.database
+    if isinstance(database, SqliteDatabase):
+        batch_size = min(batch_size, 999 // len(model._meta.fields))
+    inserted = 0
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) == batch_size:
+            with database.atomic():
+                model.insert_many(batch).execute()
+            inserted += len(batch)
+            batch = []
+    if batch:
+        with database.atomic():
+            model.insert_many(batch).execute()
+        inserted += len(batch)
+    return inserted
+
+
+def next_id(model):
+    """The id the next row of model will get when ids are assigned up front."""
+    return (model.select(model.id).order_by(model.id.desc()).scalar() or 0) + 1
+
+
+def load_dummy_users(count, password_hash=None):
+    """Bulk-loads fake users.
+
+    Every user gets the same password_hash, by default one bcrypt hash of
+    a fake password, instead of a hash per user.
+
+    Returns:
+            List of the new user ids.
+    """
+    if password_hash is None:
+        password_hash = password_context.encrypt(utilities.fake.password())
+    first_id = next_id(User)
+
+    def rows():
+        for user_id in range(first_id, first_id + count):
+            uuid = utilities.generate_UUID()
+            yield {"id": user_id, "uuid": uuid, "password": password_hash,
+                   "email": uuid.lower() + "@" + utilities.fake.free_email_domain(),
+                   "public_email": utilities.fake.free_email(),
+                   "name": utilities.fake.name(), "bio": utilities.fake.text()}
+    bulk_insert(User, rows())
+    return range(first_id, first_id + count)
+
+
+def load_dummy_sites(owner_ids, sites_per_owner=1):
+    """Bulk-loads fake sites for existing users.
+
+    Returns:
+            List of (site id, owner id).
+    """
+    first_id = next_id(Site)
+    sites = [(first_id + i, owner_id) for i, owner_id in enumerate(
+        owner_id for owner_id in owner_ids for j in range(sites_per_owner))]
+
+    def rows():
+        for site_id, owner_id in sites:
+            uuid = utilities.generate_UUID()
+            yield {"id": site_id, "uuid": uuid, "owner": owner_id,
+                   "domain": uuid.lower() + "." + utilities.fake.domain_name(),
+                   "description": utilities.fake.text(max_nb_chars=200),
+                   "title": utilities.fake.sentence(nb_words=6, variable_nb_words=True)}
+    bulk_insert(Site, rows())
+    return sites
+
+
+def load_dummy_themes(site_ids):
+    """Bulk-loads the dummy theme for existing sites.
+    """
+    template = get_dummy_template()
+    return bulk_insert(Theme, ({"uuid": utilities.generate_UUID(), "site": site_id,
+                                "template": template} for site_id in site_ids))
+
+
+def bulk_insert_posts(rows, batch_size=BULK_BATCH_SIZE):
+    """Bulk-inserts post row dictionaries, with their tag index rows.
+
+    Rows must carry their ids. Each batch of posts is inserted before the
+    tag rows that reference it.
+
+    Returns:
+            (posts inserted, tag rows inserted)
+    """
+    counts = [0, 0]
+
+    def flush(batch):
+        counts[0] += bulk_insert(Post, batch, batch_size)
+        counts[1] += bulk_insert(PostTag, (
+            {"site": row["site"], "tag": tag, "post": row["id"],
+             "created_date": row["created_date"]}
+            for row in batch for tag in set(row["tags"])), batch_size)
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) == batch_size:
+            flush(batch)
+            batch = []
+    if batch:
+        flush(batch)
+    return tuple(counts)
+
+
+def load_dummy_posts(sites, posts_per_site=10):
+    """Bulk-loads fake posts, and their tag index rows, for existing sites.
+
+    Args:
+            sites (list): (site id, author id) pairs.
+
+            posts_per_site (int): Posts per site, a minute apart, newest last.
+
+    Returns:
+            Number of posts inserted.
+    """
+    now = datetime.datetime.now()
+    first_id = next_id(Post)
+
+    def rows():
+        post_id = first_id
+        for site_id, author_id in sites:
+            for i in range(posts_per_site):
+                uuid = utilities.generate_UUID()
+                title = utilities.fake.sentence(nb_words=4)
+                yield {"id": post_id, "uuid": uuid, "site": site_id, "author": author_id,
+                       "title": title,
+                       "slug": utilities.fake.slug(title) + "-" + uuid.lower(),
+                       "description": utilities.fake.text(max_nb_chars=200),
+                       "body": utilities.fake.paragraph(nb_sentences=15),
+                       "tags": utilities.fake.words(nb=3) + ["tag"],
+                       "created_date": now - datetime.timedelta(minutes=posts_per_site - i)}
+                post_id += 1
+    return bulk_insert_posts(rows())[0]
+
+
+def load_dummy_data(users=10, sites_per_user=1, posts_per_site=10):
+    """Bulk-loads a fake platform, each site with a theme and posts by its owner.
+
+    Returns:
+            List of (site id, owner id).
+    """
+    sites = load_dummy_sites(load_dummy_users(users), sites_per_user)
+    load_dummy_themes([site_id for site_id, owner_id in sites])
+    load_dummy_posts(sites, posts_per_site)
+    return sites
+
+
+####################################################
+# Test Database
+####################################################
+MODELS = [User, Site, Theme, Post, PostTag]
+
+
+def reset_db():
+    """Drops and recreates every table. Only for tests and fixtures.
+    """
+    database = BaseModel._meta.database
+    database.drop_tables(MODELS, safe=True)
+    database.create_tables(MODELS)
@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+"""Works out which rendered outputs a site mutation invalidates.
+
+Each plan function takes the facts about one event and returns a set of
+targets. A target is a tuple whose first item is one of the kinds below;
+tasks.dispatch_plan maps every kind to the task that renders it.
+"""
+
+import unittest
+
+
+####################################################
+# Targets
+####################################################
+
+POST = "post"
+"""(POST, post_uuid): a single post page."""
+
+UNPUBLISH = "unpublish"
+"""(UNPUBLISH, slug): remove a deleted post's page."""
+
+TAG = "tag"
+"""(TAG, tag, newest_only[, page]): the listing pages for one tag."""
+
+USER = "user"
+"""(USER, user_uuid, newest_only[, page]): the listing pages for one author."""
+
+ARCHIVE = "archive"
+"""(ARCHIVE, newest_only[, page]): the site archive.
+
+Listing targets end in a page number when only that page needs rendering.
+"""
+
+INDEX = "index"
+RSS = "rss"
+SITEMAP = "sitemap"
+ROBOTS = "robots"
+DOMAIN = "domain"
+ALL_POSTS = "all_posts"
+ALL_TAGS = "all_tags"
+ALL_USERS = "all_users"
+
+LISTINGS = set([(INDEX,), (RSS,), (SITEMAP,)])
+EVERYTHING = set([(ARCHIVE, False), (ALL_POSTS,), (ALL_TAGS,),
+                  (ALL_USERS,)]) | LISTINGS
+
+
+def normalize(targets):
+    """Drops newest-only and single page renders already covered by a full render."""
+    targets = set(targets)
+    for target in list(targets):
+        if target[-1] is True and target[:-1] + (False,) in targets:
+            targets.discard(target)
+        elif type(target[-1]) is int and target[:-1] in targets:
+            targets.discard(target)
+    return targets
+
+
+def pin_pages(targets, pages):
+    """Narrows full listing renders to single pages.
+
+    pages maps listing targets, like (ARCHIVE, False), to the one page of
+    that listing that needs rendering. Other targets are kept whole.
+    """
+    return set(target + (pages[target],) if target in pages else target
+               for target in targets)
+
+
+def listing_targets(tags, author_uuid, newest_only):
+    targets = set([(ARCHIVE, newest_only), (USER, author_uuid, newest_only)])
+    for tag in tags:
+        targets.add((TAG, tag, newest_only))
+    return targets | LISTINGS
+
+
+####################################################
+# Events
+####################################################
+
+
+def plan_post_created(post_uuid, author_uuid, tags):
+    """A new post lands on top of every listing it belongs to."""
+    targets = set([(POST, post_uuid)])
+    targets |= listing_targets(tags, author_uuid, True)
+    return normalize(targets)
+
+
+def plan_post_edited(post_uuid, author_uuid, tags, old_tags=(), old_author_uuid=None):
+    """An edit can change what any listing holding the post shows."""
+    targets = set([(POST, post_uuid)])
+    targets |= listing_targets(set(tags) | set(old_tags), author_uuid, False)
+    if old_author_uuid is not None:
+        targets.add((USER, old_author_uuid, False))
+    return normalize(targets)
+
+
+def plan_post_deleted(slug, author_uuid, tags):
+    targets = set([(UNPUBLISH, slug)])
+    targets |= listing_targets(tags, author_uuid, False)
+    return normalize(targets)
+
+
+def plan_tags_changed(post_uuid, tags, old_tags):
+    """Only tags the post joined or left change membership."""
+    targets = set([(POST, post_uuid)])
+    for tag in set(tags) ^ set(old_tags):
+        targets.add((TAG, tag, False))
+    return normalize(targets)
+
+
+def plan_author_renamed(author_uuid, posts):
+    """posts is a list of (post_uuid, tags) for the author's posts."""
+    targets = set([(ARCHIVE, False), (USER, author_uuid, False)]) | LISTINGS
+    for post_uuid, tags in posts:
+        targets.add((POST, post_uuid))
+        for tag in tags:
+            targets.add((TAG, tag, False))
+    return normalize(targets)
+
+
+def plan_theme_changed():
+    return set(EVERYTHING)
+
+
+def plan_domain_changed():
+    """The domain appears in feeds, sitemaps, robots.txt and the theme context."""
+    return set(EVERYTHING) | set([(DOMAIN,), (ROBOTS,)])
+
+
+####################################################
+# Tests
+####################################################
+
+
+class PlannerTest(unittest.TestCase):
+
+    def test_Post_Created(self):
+        targets = plan_post_created("p", "u", ["a", "b"])
+        self.assertIn((POST, "p"), targets)
+        self.assertIn((ARCHIVE, True), targets)
+        self.assertIn((TAG, "a", True), targets)
+        self.assertIn((USER, "u", True), targets)
+        self.assertNotIn((ALL_POSTS,), targets)
+
+    def test_Post_Edited_Old_Tags(self):
+        targets = plan_post_edited("p", "u", ["a"], old_tags=["b"])
+        self.assertIn((TAG, "a", False), targets)
+        self.assertIn((TAG, "b", False), targets)
+
+    def test_Post_Edited_Old_Author(self):
+        targets = plan_post_edited("p", "u", ["a"], old_author_uuid="v")
+        self.assertIn((USER, "u", False), targets)
+        self.assertIn((USER, "v", False), targets)
+
+    def test_Post_Deleted(self):
+        targets = plan_post_deleted("slug", "u", ["a"])
+        self.assertIn((UNPUBLISH, "slug"), targets)
+        self.assertIn((ARCHIVE, False), targets)
+
+    def test_Tags_Changed(self):
+        targets = plan_tags_changed("p", ["a", "b"], ["b", "c"])
+        self.assertEqual(targets, set([(POST, "p"), (TAG, "a", False),
+                                       (TAG, "c", False)]))
+
+    def test_Normalize(self):
+        targets = normalize([(ARCHIVE, True), (ARCHIVE, False)])
+        self.assertEqual(targets, set([(ARCHIVE, False)]))
+
+    def test_Normalize_Pages(self):
+        targets = normalize([(ARCHIVE, False, 3), (ARCHIVE, False), (TAG, "a", False, 2)])
+        self.assertEqual(targets, set([(ARCHIVE, False), (TAG, "a", False, 2)]))
+
+    def test_Pin_Pages(self):
+        targets = plan_post_edited("p", "u", ["a"])
+        targets = pin_pages(targets, {(ARCHIVE, False): 3, (TAG, "a", False): 1})
+        self.assertIn((ARCHIVE, False, 3), targets)
+        self.assertIn((TAG, "a", False, 1), targets)
+        self.assertIn((USER, "u", False), targets)
+        self.assertNotIn((ARCHIVE, False), targets)
+
+    def test_Domain_Changed(self):
+        targets = plan_domain_changed()
+        self.assertIn((ROBOTS,), targets)
+        self.assertIn((ALL_POSTS,), targets)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+"""Rebuild every site, or a filtered set of sites, without the broker.
+
+Sites are rendered with render.render_site in a multiprocessing pool. Each
+site is rendered under its own models.connection() in the worker.
+
+    python rebuild.py --processes 32 --subscription-level pro
+"""
+import argparse
+import logging
+import logging.handlers
+import multiprocessing
+import time
+import traceback
+import unittest
+
+from peewee import OperationalError, SqliteDatabase
+
+import models
+import render
+
+
+####################################################
+# Logging Boilerplate
+####################################################
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+formatter = logging.Formatter('%(asctime)15s - %(levelname)s - %(message)s')
+console_handle = logging.StreamHandler()
+console_handle.setFormatter(formatter)
+logger.addHandler(console_handle)
+LOG_FILENAME = "muchamuck_rebuild.log"
+file_handle = logging.handlers.RotatingFileHandler(
+    LOG_FILENAME, maxBytes=5 * 1024 * 1024, backupCount=5)
+file_handle = logging.FileHandler('muchamuck_rebuild.log')
+file_handle.setFormatter(formatter)
+logger.addHandler(file_handle)
+
+PROGRESS_EVERY = 100
+
+
+####################################################
+# Workers
+####################################################
+
+
+def init_worker():
+    """Drops the connections each pool process inherited from the parent."""
+    models.db.reset_after_fork()
+
+
+def rebuild_site(uuid):
+    """Renders one site. Failures are returned rather than raised so one bad
+    site does not stop the run.
+
+    Returns:
+            (uuid, manifest counts or None, error string or None)
+    """
+    try:
+        with models.connection():
+            return uuid, render.render_site(uuid), None
+    except Exception:
+        return uuid, None, traceback.format_exc()
+
+
+####################################################
+# Rebuild
+####################################################
+
+
+def select_site_uuids(subscription_levels=None, uuids=None):
+    query = models.Site.select(models.Site.uuid).order_by(models.Site.id)
+    if subscription_levels:
+        query = query.where(models.Site.subscription_level << subscription_levels)
+    if uuids:
+        query = query.where(models.Site.uuid << uuids)
+    return [site.uuid for site in query]
+
+
+def rebuild(site_uuids, processes=None):
+    """Renders site_uuids across a process pool, logging progress.
+
+    Raises the database's error straight away if it cannot be reached,
+    instead of failing every site.
+
+    Returns:
+            Dictionary of totals for the run.
+    """
+    with models.connection():
+        pass
+    render.build_render_workspace()
+    totals = {"sites": 0, "failed": 0, "written": 0, "skipped": 0, "deleted": 0}
+    started = time.time()
+    pool = multiprocessing.Pool(processes, init_worker)
+    try:
+        for uuid, counts, error in pool.imap_unordered(rebuild_site, site_uuids):
+            totals["sites"] += 1
+            if error:
+                totals["failed"] += 1
+                logger.error("rebuild.rebuild_site(" + uuid + ") failed\n" + error)
+            else:
+                for key in ("written", "skipped", "deleted"):
+                    totals[key] += counts[key]
+            if totals["sites"] % PROGRESS_EVERY == 0:
+                log_progress(totals, len(site_uuids), started)
+        pool.close()
+    except KeyboardInterrupt:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+    totals["seconds"] = time.time() - started
+    log_progress(totals, len(site_uuids), started)
+    return totals
+
+
+def log_progress(totals, site_count, started):
+    elapsed = max(time.time() - started, 0.001)
+    logger.info("rebuild %d/%d sites, %d failed, %.1f sites/s, %.1f files/s written, %d skipped" % (
+        totals["sites"], site_count, totals["failed"], totals["sites"] / elapsed,
+        totals["written"] / elapsed, totals["skipped"]))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--processes", type=int, default=None,
+                        help="pool size, defaults to the number of CPUs")
+    parser.add_argument("--subscription-level", action="append",
+                        dest="subscription_levels",
+                        help="only sites on this subscription level, repeatable")
+    parser.add_argument("--site", action="append", dest="uuids",
+                        help="only this site uuid, repeatable")
+    args = parser.parse_args(argv)
+    with models.connection():
+        site_uuids = select_site_uuids(args.subscription_levels, args.uuids)
+    logger.info("rebuild starting for " + str(len(site_uuids)) + " sites")
+    totals = rebuild(site_uuids, args.processes)
+    return 1 if totals["failed"] else 0
+
+
+####################################################
+# Tests
+####################################################
+
+
+class RebuildTest(unittest.TestCase):
+
+    def setUp(self):
+        models.reset_db()
+        render.site_cache.clear()
+        render.build_render_workspace()
+
+    def tearDown(self):
+        render.clear_render_workspace()
+
+    def test_Rebuild(self):
+        user, site, posts = render.create_dummy_data()
+        site_uuids = select_site_uuids(uuids=[site.uuid])
+        self.assertEqual(site_uuids, [site.uuid])
+        totals = rebuild(site_uuids, processes=2)
+        self.assertEqual(totals["sites"], 1)
+        self.assertEqual(totals["failed"], 0)
+        self.assertTrue(totals["written"] > len(posts))
+
+    def test_Unreachable_Database(self):
+        database = models.BaseModel._meta.database
+        models.BaseModel._meta.database = SqliteDatabase("/nonexistent/muckamuck.db")
+        try:
+            self.assertRaises(OperationalError, rebuild, ["site"], processes=1)
+        finally:
+            models.BaseModel._meta.database = database
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -1,17 +1,26 @@
 # -*- coding: utf-8 -*-
+import collections
 import datetime
 from email import utils
+import gzip
+import hashlib
+import io
 import jinja2
+import json
 import logging
 import logging.handlers
 import math
 import os
+import re
 import shutil
+import sqlite3
+import threading
 import time
 import unittest
 
 import config
 import models
+import stats
 
 from jinja2.sandbox import SandboxedEnvironment
 
@@ -46,6 +55,257 @@ logger.addHandler(file_handle)
 MUCKAMUCK_SITES = os.path.join(config.MUCKAMUCK_DISK, "sites")
 MUCKAMUCK_SITES_BY_UUID_PATH = os.path.join(MUCKAMUCK_SITES, "uuid")
 MUCKAMUCK_SITES_BY_DOMAIN_PATH = os.path.join(MUCKAMUCK_SITES, "domain")
+MUCKAMUCK_STATE_PATH = os.path.join(config.MUCKAMUCK_DISK, "state")
+"""Render bookkeeping, such as output manifests and page cursors, kept
+outside the served site directories."""
+TEMPLATE_CACHE_SIZE = getattr(config, "TEMPLATE_CACHE_SIZE", 128)
+STABLE_PAGINATION = getattr(config, "STABLE_PAGINATION", False)
+SITEMAP_URL_LIMIT = getattr(config, "SITEMAP_URL_LIMIT", 50000)
+RSS_ITEM_CACHE_SIZE = getattr(config, "RSS_ITEM_CACHE_SIZE", 4096)
+SITE_CACHE_SIZE = getattr(config, "SITE_CACHE_SIZE", 1024)
+SITE_CACHE_TTL = getattr(config, "SITE_CACHE_TTL", 60)
+CURSOR_JOIN = "page_cursor"
+MANIFEST_LOCK_TIMEOUT = 30
+"""Seconds a render waits for another process's manifest transaction."""
+
+QUERY_BUDGETS = {
+    "generate_archives": 3,
+    "generate_index": 3,
+    "generate_post": 2,
+    "generate_posts": 2,
+    "generate_robot_txt": 1,
+    "generate_site_rss_feed": 2,
+    "generate_site_sitemap": 2,
+    "generate_tag_pages": 3,
+    "generate_user_pages": 4,
+    "render_site": 2,
+}
+"""Most queries each generator may issue with a cold site cache, however
+many posts a site has. Each is the count the generator runs today;
+RenderTest.test_Query_Budgets checks them and that a 1000 post site needs
+no more queries than a 10 post one."""
+
+stats.instrument_database(models.db)
+
+####################################################
+# Template Cache
+####################################################
+
+
+class LRUCache(object):
+    """Bounded, thread-safe LRU mapping with hit/miss counters."""
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._entries.pop(key, None)
+            if value is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._entries[key] = value
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = value
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def discard(self, predicate):
+        """Drops every entry whose key satisfies predicate."""
+        with self._lock:
+            for key in list(self._entries):
+                if predicate(key):
+                    del self._entries[key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {"hits": self.hits, "misses": self.misses,
+                    "hit_rate": float(self.hits) / lookups if lookups else 0.0,
+                    "size": len(self._entries), "max_size": self.max_size}
+
+
+class TemplateCache(LRUCache):
+    """Compiled theme templates.
+
+    Entries are keyed by theme uuid plus a hash of the template text, so an
+    edited theme never serves a stale compile even in a worker that missed
+    the invalidation.
+    """
+
+    def get_template(self, theme):
+        key = (theme.uuid, hash_template(theme.template))
+        template = self.get(key)
+        if template is None:
+            template = sandbox_env.from_string(theme.template)
+            self.put(key, template)
+        return template
+
+    def invalidate(self, theme_uuid):
+        self.discard(lambda key: key[0] == theme_uuid)
+
+
+class TTLCache(LRUCache):
+    """LRUCache whose entries also expire ttl seconds after they are put."""
+
+    def __init__(self, max_size, ttl):
+        super(TTLCache, self).__init__(max_size)
+        self.ttl = ttl
+
+    def get(self, key):
+        entry = super(TTLCache, self).get(key)
+        if entry is None:
+            return None
+        expires, value = entry
+        if expires < time.time():
+            with self._lock:
+                self.hits -= 1
+                self.misses += 1
+                if self._entries.get(key) is entry:
+                    del self._entries[key]
+            return None
+        return value
+
+    def put(self, key, value):
+        super(TTLCache, self).put(key, (time.time() + self.ttl, value))
+
+    def discard_values(self, predicate):
+        """Drops every entry whose value satisfies predicate."""
+        with self._lock:
+            for key, (expires, value) in list(self._entries.items()):
+                if predicate(value):
+                    del self._entries[key]
+
+
+class SiteCache(TTLCache):
+    """(site, theme) pairs by site uuid, id and domain.
+
+    One query fills all three keys; theme is None for a site without one.
+    Cached sites are shared between callers and must not be modified.
+    Entries are dropped on Site and Theme saves in this process and by
+    invalidate_site; the TTL bounds how long a change made elsewhere can go
+    unseen.
+    """
+
+    def lookup(self, field, value):
+        site_theme = self.get((field, value))
+        if site_theme is None:
+            site = models.Site.select(models.Site, models.User, models.Theme).join(
+                models.User).switch(models.Site).join(
+                models.Theme, models.JOIN_LEFT_OUTER,
+                on=(models.Theme.site == models.Site.id)).where(
+                getattr(models.Site, field) == value).get()
+            site_theme = (site, site.theme if site.theme.id is not None else None)
+            for key in ("uuid", "id", "domain"):
+                self.put((key, getattr(site, key)), site_theme)
+        return site_theme
+
+    def invalidate(self, site_uuid=None, site_id=None):
+        self.discard_values(lambda site_theme: site_theme[0].uuid == site_uuid or
+                            site_theme[0].id == site_id)
+
+
+def hash_template(template_text):
+    if isinstance(template_text, unicode):
+        template_text = template_text.encode("utf-8")
+    return hashlib.sha1(template_text).hexdigest()
+
+
+def hash_values(*values):
+    """Fingerprints a sequence of field values; None hashes like ""."""
+    digest = hashlib.sha1()
+    for value in values:
+        if value is None:
+            value = u""
+        elif not isinstance(value, basestring):
+            value = unicode(value)
+        if isinstance(value, unicode):
+            value = value.encode("utf-8")
+        digest.update(value + "\0")
+    return digest.hexdigest()
+
+
+template_cache = TemplateCache(TEMPLATE_CACHE_SIZE)
+rss_item_cache = LRUCache(RSS_ITEM_CACHE_SIZE)
+site_cache = SiteCache(SITE_CACHE_SIZE, SITE_CACHE_TTL)
+stats.register_cache("template", template_cache)
+stats.register_cache("rss_item", rss_item_cache)
+stats.register_cache("site", site_cache)
+
+
+def render_template(template, **context):
+    started = time.time()
+    try:
+        return template.render(**context)
+    finally:
+        stats.add(template_seconds=time.time() - started)
+
+
+def get_theme_template(theme):
+    return template_cache.get_template(theme)
+
+
+def get_site_theme(uuid):
+    """Looks up a site, joined to its owner, and its theme through site_cache.
+
+    Returns:
+            (site, theme)
+    """
+    return require_theme(site_cache.lookup("uuid", uuid))
+
+
+def get_site_theme_by_id(site_id):
+    return require_theme(site_cache.lookup("id", site_id))
+
+
+def get_site_theme_by_domain(domain):
+    return require_theme(site_cache.lookup("domain", domain))
+
+
+def require_theme(site_theme):
+    if site_theme[1] is None:
+        raise models.Theme.DoesNotExist("site " + site_theme[0].uuid + " has no theme")
+    return site_theme
+
+
+def get_site(uuid):
+    return site_cache.lookup("uuid", uuid)[0]
+
+
+def invalidate_site(uuid=None, site_id=None):
+    """Drops a site and its theme from this process's site_cache."""
+    site_cache.invalidate(uuid, site_id)
+
+
+def invalidate_saved_model(instance):
+    """models.save_listeners hook: saved sites and themes leave the caches."""
+    if isinstance(instance, models.Site):
+        invalidate_site(instance.uuid, instance.id)
+    elif isinstance(instance, models.Theme):
+        invalidate_site(site_id=instance._data.get("site"))
+        invalidate_theme_template(instance.uuid)
+
+
+models.save_listeners.append(invalidate_saved_model)
+
+
+def invalidate_theme_template(theme_uuid):
+    template_cache.invalidate(theme_uuid)
 
 ####################################################
 # General Helpers
@@ -122,38 +382,271 @@ def get_site_robots_txt_path(uuid):
     return os.path.join(MUCKAMUCK_SITES_BY_UUID_PATH, uuid, "robots.txt")
 
 
+def get_site_sitemap_chunk_path(uuid, number):
+    return os.path.join(MUCKAMUCK_SITES_BY_UUID_PATH, uuid, "sitemap-%d.xml.gz" % number)
+
+
+def get_state_path(path):
+    """Maps a path under a site directory to its place in the state tree."""
+    return os.path.join(MUCKAMUCK_STATE_PATH, os.path.relpath(path, MUCKAMUCK_SITES_BY_UUID_PATH))
+
+
+def get_site_manifest_path(uuid):
+    return os.path.join(get_state_path(get_site_path(uuid)), "manifest.sqlite")
+
+
+LEGACY_STATE_FILES = (".manifest.json", ".manifest.json.lock")
+"""Bookkeeping files older renders left in the served site directory."""
+
+
 def politely_make_dir(path):
     if not os.path.exists(path):
         os.makedirs(path)
 
 
+def get_temp_path(path):
+    return "%s.%d.%d.tmp" % (path, os.getpid(), threading.current_thread().ident)
+
+
+def remove_temp_file(temp_path):
+    """Deletes a temp file left by a failed write. prune() skips .tmp files,
+    so nothing else would."""
+    try:
+        os.remove(temp_path)
+    except OSError:
+        pass
+
+
+def write_file_atomically(path, content):
+    """Writes to a temp file beside path and renames it into place.
+
+    Readers such as nginx see either the old file or the new one, never a
+    half-written page.
+    """
+    temp_path = get_temp_path(path)
+    try:
+        file_object = open(temp_path, "wb")
+        try:
+            file_object.write(content)
+        finally:
+            file_object.close()
+        os.rename(temp_path, path)
+    except Exception:
+        remove_temp_file(temp_path)
+        raise
+    stats.add(bytes_written=len(content), files_written=1)
+
+
+def link_file_atomically(source_path, path):
+    """Hardlinks source_path to path, replacing path atomically.
+
+    Returns False if the filesystem cannot hardlink.
+    """
+    temp_path = get_temp_path(path)
+    try:
+        os.link(source_path, temp_path)
+    except OSError:
+        return False
+    try:
+        os.rename(temp_path, path)
+    except Exception:
+        remove_temp_file(temp_path)
+        raise
+    stats.add(files_written=1)
+    return True
+
+
 def build_render_workspace():
     politely_make_dir(MUCKAMUCK_SITES)
     politely_make_dir(MUCKAMUCK_SITES_BY_UUID_PATH)
     politely_make_dir(MUCKAMUCK_SITES_BY_DOMAIN_PATH)
+    politely_make_dir(MUCKAMUCK_STATE_PATH)
 
 
 def clear_render_workspace():
     shutil.rmtree(MUCKAMUCK_SITES)
+    shutil.rmtree(MUCKAMUCK_STATE_PATH, ignore_errors=True)
+
+####################################################
+# Output Manifest
+####################################################
+
+
+class OutputManifest(object):
+    """Content hashes of every file rendered into one site directory.
+
+    Writes whose bytes hash the same as the last render are skipped, so an
+    unchanged page keeps its mtime and is left alone by rsync/CDN sync. The
+    hashes live in a SQLite table in the site's state directory, so a
+    generator only reads and writes the entries for the files it touches.
+    """
+
+    def __init__(self, uuid, preload=False):
+        """preload reads every entry up front, for renders that touch most
+        of the site."""
+        stats.set_site(uuid)
+        self.uuid = uuid
+        self.site_path = get_site_path(uuid)
+        self.path = get_site_manifest_path(uuid)
+        self.connection = None
+        self.hashes = self.load() if preload else {}
+        self.changes = {}
+        self.seen = set()
+        self.written = 0
+        self.skipped = 0
+        self.deleted = 0
+
+    def connect(self):
+        if self.connection is None:
+            politely_make_dir(os.path.dirname(self.path))
+            self.connection = sqlite3.connect(self.path, timeout=MANIFEST_LOCK_TIMEOUT)
+            self.connection.text_factory = str
+            self.connection.execute("CREATE TABLE IF NOT EXISTS manifest "
+                                    "(path TEXT PRIMARY KEY, digest TEXT NOT NULL)")
+        return self.connection
+
+    def load(self):
+        """Reads every entry.
+
+        Returns:
+                Dictionary of path, relative to the site directory, to digest.
+        """
+        return dict(self.connect().execute("SELECT path, digest FROM manifest"))
+
+    def digest(self, key):
+        """The digest key was last written with, or None."""
+        if key not in self.hashes:
+            row = self.connect().execute(
+                "SELECT digest FROM manifest WHERE path = ?", (key,)).fetchone()
+            self.hashes[key] = row[0] if row else None
+        return self.hashes[key]
+
+    def key(self, path):
+        key = os.path.relpath(path, self.site_path)
+        return key.encode("utf-8") if isinstance(key, unicode) else key
+
+    def write(self, path, content, digest=None):
+        """Writes content unless path already holds it.
+
+        digest defaults to the hash of content. Callers that can fingerprint
+        their inputs pass that instead and check unchanged() first, so they
+        skip building the content at all.
+        """
+        if isinstance(content, unicode):
+            content = content.encode("utf-8")
+        if digest is None:
+            digest = hashlib.sha1(content).hexdigest()
+        if self.unchanged(path, digest):
+            return False
+        write_file_atomically(path, content)
+        self.record(self.key(path), digest)
+        return True
+
+    def unchanged(self, path, digest):
+        """Returns True, counting a skip, if path was last written with digest."""
+        key = self.key(path)
+        self.seen.add(key)
+        if self.digest(key) == digest and os.path.isfile(path):
+            self.skipped += 1
+            return True
+        return False
+
+    def link(self, source_path, path):
+        """Publishes a copy of an already written file at path.
+
+        Uses a hardlink instead of writing the bytes again, falling back to
+        a normal write where hardlinks are not available.
+        """
+        digest = self.digest(self.key(source_path))
+        key = self.key(path)
+        self.seen.add(key)
+        if digest is not None and self.digest(key) == digest and os.path.isfile(path):
+            self.skipped += 1
+            return False
+        if not link_file_atomically(source_path, path):
+            with open(source_path, "rb") as file_object:
+                write_file_atomically(path, file_object.read())
+        self.record(key, digest)
+        return True
+
+    def record(self, key, digest):
+        self.hashes[key] = digest
+        self.changes[key] = digest
+        self.written += 1
+
+    def remove(self, path):
+        key = self.key(path)
+        if os.path.isfile(path):
+            os.remove(path)
+            self.deleted += 1
+        self.hashes[key] = None
+        self.changes[key] = None
+
+    def prune(self, dir_path):
+        """Deletes files in dir_path that were not written during this run."""
+        for file_name in os.listdir(dir_path):
+            if file_name.endswith(".tmp"):
+                continue
+            path = os.path.join(dir_path, file_name)
+            if os.path.isfile(path) and self.key(path) not in self.seen:
+                self.remove(path)
+
+    def prune_dirs(self, dir_path, names):
+        """Deletes the subdirectories of dir_path not named in names."""
+        if not os.path.isdir(dir_path):
+            return
+        for dir_name in os.listdir(dir_path):
+            path = os.path.join(dir_path, dir_name)
+            if dir_name in names or not os.path.isdir(path):
+                continue
+            for file_name in os.listdir(path):
+                self.remove(os.path.join(path, file_name))
+            shutil.rmtree(path)
+            shutil.rmtree(get_state_path(path), ignore_errors=True)
+
+    def save(self):
+        """Applies this run's changes to the manifest in one transaction.
+
+        Other generators for the same site may have saved since this one
+        looked entries up, so only the keys touched here are written.
+        """
+        if self.changes:
+            with self.connect():
+                self.connection.executemany(
+                    "DELETE FROM manifest WHERE path = ?",
+                    [(key,) for key, digest in self.changes.items() if digest is None])
+                self.connection.executemany(
+                    "INSERT OR REPLACE INTO manifest (path, digest) VALUES (?, ?)",
+                    [(key, digest) for key, digest in self.changes.items() if digest is not None])
+            self.changes = {}
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+        counts = self.counts()
+        logger.info("render.manifest(" + self.uuid + ") written=%(written)d skipped=%(skipped)d deleted=%(deleted)d" % counts)
+        return counts
+
+    def counts(self):
+        return {"written": self.written, "skipped": self.skipped,
+                "deleted": self.deleted}
 
 ####################################################
 # Archive
 ####################################################
 
 
-def generate_archives(uuid):
-    delete_archives(uuid)
+@stats.timed
+def generate_archives(uuid, newest_only=False, page=None):
     dir_path = get_site_archive_path(uuid)
     politely_make_dir(dir_path)
+    manifest = OutputManifest(uuid)
     title = "Archive"
-    site = models.Site.select().where(models.Site.uuid == uuid).get()
-    template = models.Theme.select().where(models.Theme.site == site).get().template
-    post_count = models.Post.select().where(models.Post.site == site).count()
-    page_count = int(math.ceil(float(post_count) / config.PAGE_ITEM_LIMIT))
-    for i in range(page_count):
-        current_page = i + 1
-        posts = models.Post.select().where(models.Post.site == site).order_by(models.Post.created_date.desc()).paginate(current_page, config.PAGE_ITEM_LIMIT)
-        make_pagination(dir_path, current_page, page_count, posts, site, template, title)
+    site, theme = get_site_theme(uuid)
+    template = get_theme_template(theme)
+    posts = models.Post.select().where(models.Post.site == site)
+    paginate_posts(dir_path, posts, site, template, title, manifest, newest_only,
+                   page=page)
+    return manifest.save()
 
 
 def delete_archives(uuid):
@@ -166,78 +659,135 @@ def delete_archives(uuid):
 ####################################################
 
 
+@stats.timed
 def generate_index(uuid):
     index_path = get_site_index_path(uuid)
-    site = models.Site.select().where(models.Site.uuid == uuid).get()
-    template = models.Theme.select().where(
-        models.Theme.site == site).get().template
-    post_count = models.Post.select().count()
-    page_count = int(math.ceil(float(post_count) / config.PAGE_ITEM_LIMIT))
-    posts = models.Post.select().where(models.Post.site == site).order_by(
-        models.Post.created_date.desc()).paginate(1, config.PAGE_ITEM_LIMIT)
+    site, theme = get_site_theme(uuid)
+    template = get_theme_template(theme)
+    page_count = count_pages(models.Post.select().where(models.Post.site == site).count())
+    posts = with_authors(models.Post.select().where(models.Post.site == site)).order_by(
+        models.Post.created_date.desc(), models.Post.id.desc()).limit(config.PAGE_ITEM_LIMIT)
     post_dicts = []
     for post in posts:
+        post.site = site
         post_dicts.append(post.to_dict())
-    index_content = sandbox_env.from_string(template).render(
-        site=site.to_dict(), posts=post_dicts, current_page=1, total_pages=page_count)
-    file_object = open(index_path, "wb")
-    file_object.write(index_content)
-    file_object.close()
+    index_content = render_template(
+        template, site=site.to_dict(), posts=post_dicts, current_page=1, total_pages=page_count)
+    manifest = OutputManifest(uuid)
+    manifest.write(index_path, index_content)
+    return manifest.save()
 
 ####################################################
 # Posts
 ####################################################
 
 
+@stats.timed
 def generate_post(uuid):
     logger.info("render.generate_post(" + uuid + ")")
-    post_from_db = models.Post.select().where(models.Post.uuid == uuid).get()
-    theme = models.Theme.select().where(
-        models.Theme.site == post_from_db.site).get()
-    template = jinja2.Template(theme.template)
+    post_from_db = with_authors(models.Post.select().where(models.Post.uuid == uuid)).get()
+    post_from_db.site, theme = get_site_theme_by_id(post_from_db.site_id)
+    template = get_theme_template(theme)
     post = post_from_db.to_dict()
     site = post_from_db.site.to_dict()
-    file_object = open(get_post_path(site['uuid'], post['slug']), "wb")
-    file_object.write(template.render(site=site, post=post))
-    file_object.close()
+    manifest = OutputManifest(site['uuid'])
+    manifest.write(get_post_path(site['uuid'], post['slug']),
+                   render_template(template, site=site, post=post))
+    return manifest.save()
+
+
+@stats.timed
+def generate_posts(site_uuid, post_uuids):
+    """Renders a batch of one site's post pages in two queries."""
+    logger.info("render.generate_posts(" + site_uuid + ", " + str(len(post_uuids)) + " posts)")
+    site, theme = get_site_theme(site_uuid)
+    template = get_theme_template(theme)
+    site_dict = site.to_dict()
+    manifest = OutputManifest(site_uuid)
+    posts = with_authors(models.Post.select().where(
+        (models.Post.site == site) & (models.Post.uuid << post_uuids)))
+    for post in posts:
+        post.site = site
+        post_dict = post.to_dict()
+        manifest.write(get_post_path(site_uuid, post_dict['slug']),
+                       render_template(template, site=site_dict, post=post_dict))
+    return manifest.save()
 
 
+@stats.timed
 def delete_post(uuid):
     post = models.Post.select().where(models.Post.uuid == uuid).get()
-    os.remove(get_post_path(post.site.uuid, post.slug))
+    return remove_post(post.site.uuid, post.slug)
+
+
+@stats.timed
+def remove_post(site_uuid, slug):
+    manifest = OutputManifest(site_uuid)
+    manifest.remove(get_post_path(site_uuid, slug))
+    return manifest.save()
 
 ####################################################
 # Robots.txt
 ####################################################
 
 
+@stats.timed
 def generate_robot_txt(uuid):
-    site = models.Site.select().where(models.Site.uuid == uuid).get()
-    file_object = open(get_site_robots_txt_path(site.uuid), "wb")
-    file_object.write("# www.robotstxt.org/\n")
-    file_object.write("Sitemap: http://")
-    file_object.write(site.domain)
-    file_object.write("/sitemap.xml\n")
-    file_object.write("# Allow crawling of all content\n")
-    file_object.write("User-agent: *\n")
-    file_object.write("Disallow:\n")
-    file_object.close()
+    site = get_site(uuid)
+    manifest = OutputManifest(uuid)
+    manifest.write(get_site_robots_txt_path(site.uuid), build_robots_txt(site))
+    return manifest.save()
+
+
+def build_robots_txt(site):
+    return "".join([
+        "# www.robotstxt.org/\n",
+        "Sitemap: http://" + site.domain + "/sitemap.xml\n",
+        "# Allow crawling of all content\n",
+        "User-agent: *\n",
+        "Disallow:\n"])
 
 ####################################################
 # RSS
 ####################################################
 
 
+@stats.timed
 def generate_site_rss_feed(uuid):
-    site = models.Site.select().where(models.Site.uuid == uuid).get()
+    site = get_site(uuid)
     posts = models.Post.select().where(models.Post.site == site).order_by(
-        models.Post.created_date.desc()).limit(config.RSS_ITEM_LIMIT)
-    template = render_env.get_template('rss.xml')
-    rss_content = template.render(
-        rss_datetime=rss_datetime, site=site, posts=posts)
-    file_object = open(get_site_rss_path(uuid), "wb")
-    file_object.write(rss_content)
-    file_object.close()
+        models.Post.created_date.desc(), models.Post.id.desc()).limit(config.RSS_ITEM_LIMIT)
+    manifest = OutputManifest(uuid)
+    write_rss_feed(manifest, site, list(posts))
+    return manifest.save()
+
+
+def write_rss_feed(manifest, site, posts):
+    """Renders rss.xml unless the channel and its top posts are unchanged.
+
+    Each <item> is rendered once per post version and kept in
+    rss_item_cache, so a feed that gains one post renders one new item.
+    """
+    item_digests = [hash_values(site.domain, post.uuid, post.slug, post.title,
+                                post.description, post.created_date) for post in posts]
+    digest = hash_values(site.title, site.domain, site.description, site.language,
+                         site.owner.public_email, *item_digests)
+    path = get_site_rss_path(site.uuid)
+    if manifest.unchanged(path, digest):
+        return
+    items = []
+    item_template = render_env.get_template('rss_item.xml')
+    for post, item_digest in zip(posts, item_digests):
+        key = (post.uuid, item_digest)
+        item = rss_item_cache.get(key)
+        if item is None:
+            item = render_template(item_template, rss_datetime=rss_datetime, site=site, post=post)
+            rss_item_cache.put(key, item)
+        items.append(item)
+    rss_content = render_template(
+        render_env.get_template('rss.xml'), rss_datetime=rss_datetime, site=site,
+        posts=posts, items=items)
+    manifest.write(path, rss_content, digest)
 
 ####################################################
 # Site
@@ -288,112 +838,462 @@ def remove_domain_symlink(uuid):
 ####################################################
 
 
+@stats.timed
 def generate_site_sitemap(uuid):
-    site = models.Site.select().where(models.Site.uuid == uuid).get()
-    file_object = open(get_site_sitemap_path(uuid), "wb")
-    file_object.write('<?xml version="1.0" encoding="UTF-8"?>\n')
-    file_object.write(
-        '<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">\n')
-    for post in models.Post.select().where(models.Post.site == site).order_by(models.Post.created_date.desc()):
-        file_object.write('<url>\n')
-        file_object.write(
-            " <loc>http://" + site.domain + "/post/" + post.slug + ".html</loc>\n")
-        file_object.write(
-            " <lastmod>" + post.created_date.strftime('%Y-%m-%d') + "</lastmod>\n")
-        file_object.write('</url>\n')
-    file_object.write('</urlset>\n')
-    file_object.close()
+    site = get_site(uuid)
+    posts = models.Post.select(models.Post.slug, models.Post.created_date).where(
+        models.Post.site == site).order_by(
+        models.Post.created_date.asc(), models.Post.id.asc()).tuples()
+    manifest = OutputManifest(uuid)
+    write_sitemaps(manifest, site, posts.iterator())
+    return manifest.save()
+
+
+def write_sitemaps(manifest, site, posts):
+    """Writes gzipped sitemap-N.xml.gz chunks and a sitemap.xml index.
+
+    posts is an oldest-first iterable of (slug, created_date) and is read
+    once. Chunks are cut from the oldest post, so new posts only change the
+    last one. A chunk is rebuilt only when the hash of its rows changes.
+    """
+    index_entries = []
+    for i, chunk in enumerate(chunk_posts(posts, SITEMAP_URL_LIMIT)):
+        path = get_site_sitemap_chunk_path(site.uuid, i + 1)
+        digest = hashlib.sha1(site.domain.encode("utf-8"))
+        for slug, created_date in chunk:
+            digest.update(slug.encode("utf-8") + "\0" + created_date.isoformat() + "\n")
+        digest = digest.hexdigest()
+        if not manifest.unchanged(path, digest):
+            manifest.write(path, build_sitemap_chunk(site, chunk), digest)
+        lastmod = max(created_date for slug, created_date in chunk)
+        index_entries.append((os.path.basename(path), lastmod))
+    for file_name in os.listdir(manifest.site_path):
+        match = re.match(r"sitemap-(\d+)\.xml\.gz$", file_name)
+        if match and int(match.group(1)) > len(index_entries):
+            manifest.remove(os.path.join(manifest.site_path, file_name))
+    manifest.write(get_site_sitemap_path(site.uuid),
+                   build_sitemap_index(site, index_entries))
+
+
+def build_sitemap_chunk(site, posts):
+    buffer = io.BytesIO()
+    gzip_file = gzip.GzipFile(fileobj=buffer, mode="wb", mtime=0)
+    gzip_file.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+                    '<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">\n')
+    for slug, created_date in posts:
+        gzip_file.write(("<url>\n <loc>http://" + site.domain + "/post/" + slug +
+                         ".html</loc>\n <lastmod>" + created_date.strftime('%Y-%m-%d') +
+                         "</lastmod>\n</url>\n").encode("utf-8"))
+    gzip_file.write('</urlset>\n')
+    gzip_file.close()
+    return buffer.getvalue()
+
+
+def build_sitemap_index(site, entries):
+    lines = ['<?xml version="1.0" encoding="UTF-8"?>\n',
+             '<sitemapindex xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">\n']
+    for file_name, lastmod in entries:
+        lines.append("<sitemap>\n <loc>http://" + site.domain + "/" + file_name +
+                     "</loc>\n <lastmod>" + lastmod.strftime('%Y-%m-%d') +
+                     "</lastmod>\n</sitemap>\n")
+    lines.append('</sitemapindex>\n')
+    return "".join(lines)
 
 ####################################################
 # Tags
 ####################################################
 
 
-def generate_tag_pages(uuid, tag):
-    delete_tag_pages(uuid, tag)
+@stats.timed
+def generate_tag_pages(uuid, tag, newest_only=False, page=None):
     dir_path = get_site_tag_path(uuid, tag)
     politely_make_dir(dir_path)
+    manifest = OutputManifest(uuid)
     title = "Posts Tagged With " + tag
-    site = models.Site.select().where(models.Site.uuid == uuid).get()
-    template = models.Theme.select().where(
-        models.Theme.site == site).get().template
-    post_count = models.Post.select().where(
-        (models.Post.site == site) & (models.Post.tags.contains(tag))).count()
-    page_count = int(math.ceil(float(post_count) / config.PAGE_ITEM_LIMIT))
-    for i in range(page_count):
-        current_page = i + 1
-        posts = models.Post.select().where((models.Post.site == site) & (models.Post.tags.contains(tag))
-                                           ).order_by(models.Post.created_date.desc()).paginate(current_page, config.PAGE_ITEM_LIMIT)
-        make_pagination(
-            dir_path, current_page, page_count, posts, site, template, title)
+    site, theme = get_site_theme(uuid)
+    template = get_theme_template(theme)
+    posts = models.Post.select().join(models.PostTag, on=(
+        models.PostTag.post == models.Post.id).alias(CURSOR_JOIN)).where(
+        (models.PostTag.site == site) & (models.PostTag.tag == tag))
+    # Order by the tag index's copies of created_date and the post id, so the
+    # pages are read in order from the index like every other listing.
+    paginate_posts(dir_path, posts, site, template, title, manifest, newest_only,
+                   order_by=(models.PostTag.created_date, models.PostTag.post), page=page)
+    return manifest.save()
 
 
 def delete_tag_pages(uuid, tag):
     dir_path = get_site_tag_path(uuid, tag)
     politely_make_dir(dir_path)
     shutil.rmtree(dir_path)
+    shutil.rmtree(get_state_path(dir_path), ignore_errors=True)
 
 ####################################################
 # Users
 ####################################################
 
 
-def generate_user_pages(site_uuid, user_uuid):
+@stats.timed
+def generate_user_pages(site_uuid, user_uuid, newest_only=False, page=None):
     dir_path = get_site_user_path(site_uuid, user_uuid)
     politely_make_dir(dir_path)
+    manifest = OutputManifest(site_uuid)
     user = models.User.select().where(models.User.uuid == user_uuid).get()
-    site = models.Site.select().where(models.Site.uuid == site_uuid).get()
-    post_count = models.Post.select().where(
-        (models.Post.site == site) & (models.Post.author == user)).count()
-    page_count = int(math.ceil(float(post_count) / config.PAGE_ITEM_LIMIT))
+    site, theme = get_site_theme(site_uuid)
     title = "Posts By " + user.public_name
-    template = models.Theme.select().where(
-        models.Theme.site == site).get().template
-    for i in range(page_count):
-        current_page = i + 1
-        posts = models.Post.select().where((models.Post.site == site) & (models.Post.author == user)
-                                           ).order_by(models.Post.created_date.desc()).paginate(current_page, config.PAGE_ITEM_LIMIT)
-        make_pagination(
-            dir_path, current_page, page_count, posts, site, template, title)
+    template = get_theme_template(theme)
+    posts = models.Post.select().where(
+        (models.Post.site == site) & (models.Post.author == user))
+    paginate_posts(dir_path, posts, site, template, title, manifest, newest_only,
+                   page=page)
+    return manifest.save()
 
 
 ####################################################
 # Pagination
 ####################################################
-def make_pagination(dir_path, current_page, page_count, posts, site, template, title):
-    file_name = os.path.join(dir_path, str(current_page) + ".html")
-    post_dicts = []
+def chunk_posts(posts, chunk_size):
+    """Consumes an iterable of posts once, yielding lists of chunk_size posts."""
+    chunk = []
     for post in posts:
-        post_dicts.append(post.to_dict())
-    page_content = sandbox_env.from_string(template).render(site=site.to_dict(
-    ), posts=post_dicts, current_page=current_page, title=title, total_pages=page_count)
-    file_object = open(file_name, "wb")
-    file_object.write(page_content)
-    file_object.close()
-    if current_page == 1:
-        file_name = os.path.join(dir_path, "index.html")
-        file_object = open(file_name, "wb")
-        file_object.write(page_content)
-        file_object.close()
+        chunk.append(post)
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def with_authors(posts):
+    """Selects each post's author in the same query, so to_dict() stays lazy-load free."""
+    return posts.select(models.Post, models.User).switch(models.Post).join(models.User)
+
+
+def count_pages(post_count):
+    return int(math.ceil(float(post_count) / config.PAGE_ITEM_LIMIT))
+
+
+def number_pages(chunks):
+    """Pairs page numbers with chunks of newest-first posts.
+
+    With STABLE_PAGINATION the chunks must come oldest-first; page 1 then
+    holds the oldest posts and each page is flipped back to newest-first.
+    """
+    if STABLE_PAGINATION:
+        return ((i + 1, chunk[::-1]) for i, chunk in enumerate(chunks))
+    return enumerate(chunks, 1)
+
+
+def scan_start(chunk):
+    """The first row of a newest-first page in the order pages are scanned."""
+    return chunk[-1] if STABLE_PAGINATION else chunk[0]
+
+
+def get_cursor(post, order_by):
+    """Reads the (created_date, id) a post row is ordered by.
+
+    Fields of another model, like the tag index, are read off the instance
+    peewee attaches for the join aliased CURSOR_JOIN. Raw values are read, so
+    a foreign key gives the id rather than a lazy lookup.
+    """
+    created_date, post_id = order_by
+    row = post if created_date.model_class is models.Post else getattr(post, CURSOR_JOIN)
+    return (row._data[created_date.name], row._data[post_id.name])
+
+
+def get_page_cursors_path(dir_path):
+    return os.path.join(get_state_path(dir_path), "pages.json")
+
+
+def parse_cursor_date(value):
+    for date_format in ("%Y-%m-%dT%H:%M:%S.%f", "%Y-%m-%dT%H:%M:%S"):
+        try:
+            return datetime.datetime.strptime(value, date_format)
+        except ValueError:
+            pass
+    raise ValueError("bad page cursor date " + value)
+
+
+def load_page_cursors(dir_path):
+    """Reads the cursor each listing page started at when last rendered.
+
+    Returns:
+            Dictionary of page number to (created_date, id), empty if the
+            listing was never rendered or was rendered in the other page order.
+    """
+    try:
+        with open(get_page_cursors_path(dir_path), "rb") as file_object:
+            saved = json.load(file_object)
+    except (IOError, ValueError):
+        return {}
+    if saved.get("stable") != STABLE_PAGINATION:
+        return {}
+    return dict((int(page), (parse_cursor_date(created_date), post_id))
+                for page, (created_date, post_id) in saved["pages"].items())
+
+
+def save_page_cursors(dir_path, page_cursors):
+    """Writes a listing's page cursors, unless they are unchanged."""
+    pages = dict((str(page), [created_date.isoformat(), post_id])
+                 for page, (created_date, post_id) in page_cursors.items())
+    content = json.dumps({"stable": STABLE_PAGINATION, "pages": pages}, sort_keys=True)
+    path = get_page_cursors_path(dir_path)
+    try:
+        with open(path, "rb") as file_object:
+            if file_object.read() == content:
+                return
+    except IOError:
+        politely_make_dir(os.path.dirname(path))
+    write_file_atomically(path, content)
+
+
+def remove_page_cursors(dir_path):
+    try:
+        os.remove(get_page_cursors_path(dir_path))
+    except OSError:
+        pass
+
+
+def find_cursor_page(dir_path, cursor):
+    """Looks up the page a post's (created_date, id) landed on when last rendered.
+
+    Returns:
+            The page number, or None if the listing has no saved cursors.
+    """
+    if STABLE_PAGINATION:
+        pages = [page for page, start in load_page_cursors(dir_path).items() if start <= cursor]
+    else:
+        pages = [page for page, start in load_page_cursors(dir_path).items() if start >= cursor]
+    return max(pages) if pages else None
+
+
+def seek(posts, cursor, order_by):
+    """Orders posts the way pages are scanned, starting at cursor.
+
+    The cursor bounds an index range on (created_date, id), so reaching a
+    deep page costs the same as reaching the first, instead of scanning every
+    page before it like LIMIT/OFFSET.
+    """
+    created_date, post_id = order_by
+    cursor_date, cursor_id = cursor
+    if STABLE_PAGINATION:
+        after = (created_date >= cursor_date) & (
+            (created_date > cursor_date) | (post_id >= cursor_id))
+        return posts.where(after).order_by(created_date.asc(), post_id.asc())
+    before = (created_date <= cursor_date) & (
+        (created_date < cursor_date) | (post_id <= cursor_id))
+    return posts.where(before).order_by(created_date.desc(), post_id.desc())
+
+
+def seek_page(posts, cursor, order_by):
+    """Selects the page of posts starting at cursor, newest first."""
+    page = list(seek(posts, cursor, order_by).limit(config.PAGE_ITEM_LIMIT))
+    return page[::-1] if STABLE_PAGINATION else page
+
+
+def paginate_posts(dir_path, posts, site, template, title, manifest, newest_only=False,
+                   order_by=None, page=None):
+    """Renders every listing page for a post query.
+
+    Costs one COUNT for the page total plus a single streamed SELECT, rather
+    than a LIMIT/OFFSET query per page. order_by is the (created_date, id)
+    field pair to sort on, the post's own by default.
+
+    The cursor each page starts at is saved beside the pages. Passing page
+    renders just that page, seeking straight to its cursor. newest_only is
+    honoured only with STABLE_PAGINATION, where new posts fill the newest
+    page and then add pages after it: it renders from the newest page of the
+    last render onwards, however many posts arrived since. Without saved
+    cursors to seek from, both fall back to rendering the whole listing.
+    """
+    order_by = order_by or (models.Post.created_date, models.Post.id)
+    created_date, post_id = order_by
+    post_count = posts.count()
+    page_count = count_pages(post_count)
+    newest_page = page_count if STABLE_PAGINATION else 1
+    posts = with_authors(posts)
+    if created_date.model_class is not models.Post:
+        posts = posts.select(models.Post, models.User, created_date, post_id)
+    page_cursors = load_page_cursors(dir_path)
+    last_newest_page = max(page_cursors) if page_cursors else None
+    full_render = False
+    if page is not None and page in page_cursors and page <= page_count:
+        pages = [(page, seek_page(posts, page_cursors[page], order_by))]
+    elif (STABLE_PAGINATION and newest_only and last_newest_page is not None and
+          last_newest_page <= page_count):
+        chunks = chunk_posts(seek(posts, page_cursors[last_newest_page], order_by).iterator(),
+                             config.PAGE_ITEM_LIMIT)
+        pages = ((last_newest_page + i, chunk[::-1]) for i, chunk in enumerate(chunks))
+    else:
+        full_render = True
+        page_cursors = {}
+        if STABLE_PAGINATION:
+            ordered_posts = posts.order_by(created_date.asc(), post_id.asc())
+        else:
+            ordered_posts = posts.order_by(created_date.desc(), post_id.desc())
+        pages = number_pages(chunk_posts(ordered_posts.iterator(), config.PAGE_ITEM_LIMIT))
+    site_dict = site.to_dict()
+    for current_page, chunk in pages:
+        if not chunk:
+            continue
+        page_cursors[current_page] = get_cursor(scan_start(chunk), order_by)
+        post_dicts = []
+        for post in chunk:
+            post.site = site
+            post_dicts.append(post.to_dict())
+        make_pagination(dir_path, current_page, page_count, post_dicts,
+                        site_dict, template, title, manifest, newest_page)
+    save_page_cursors(dir_path, page_cursors)
+    if full_render:
+        manifest.prune(dir_path)
+
+
+def paginate_post_dicts(dir_path, post_dicts, site_dict, template, title, manifest,
+                        cursors=None):
+    """Renders every listing page for an in-memory, newest-first list of post dicts.
+
+    cursors, the (created_date, id) of each post, are saved as the pages'
+    cursors when given. Listings without them lose their saved cursors.
+    """
+    page_count = count_pages(len(post_dicts))
+    rows = zip(post_dicts, cursors or [None] * len(post_dicts))
+    if STABLE_PAGINATION:
+        newest_page = page_count
+        pages = number_pages(chunk_posts(reversed(rows), config.PAGE_ITEM_LIMIT))
+    else:
+        newest_page = 1
+        pages = number_pages(chunk_posts(rows, config.PAGE_ITEM_LIMIT))
+    page_cursors = {}
+    for current_page, chunk in pages:
+        page_cursors[current_page] = scan_start(chunk)[1]
+        make_pagination(dir_path, current_page, page_count,
+                        [post_dict for post_dict, cursor in chunk],
+                        site_dict, template, title, manifest, newest_page)
+    if cursors is not None:
+        save_page_cursors(dir_path, page_cursors)
+    else:
+        remove_page_cursors(dir_path)
+    manifest.prune(dir_path)
+
+
+def make_pagination(dir_path, current_page, page_count, post_dicts, site_dict, template, title, manifest, newest_page=1):
+    file_name = os.path.join(dir_path, str(current_page) + ".html")
+    page_content = render_template(template, site=site_dict, posts=post_dicts, current_page=current_page,
+                                   title=title, total_pages=page_count, newest_page=newest_page)
+    manifest.write(file_name, page_content)
+    if current_page == newest_page:
+        manifest.link(file_name, os.path.join(dir_path, "index.html"))
+
+####################################################
+# Whole Site
+####################################################
+
+
+class SiteSnapshot(object):
+    """Everything needed to render one site, loaded in two queries.
+
+    The site with its owner and theme, and every post joined to its author,
+    are selected up front. Posts share the one site instance, so to_dict()
+    never falls back to a lazy lookup.
+    """
+
+    def __init__(self, uuid):
+        self.site, self.theme = get_site_theme(uuid)
+        self.template = get_theme_template(self.theme)
+        self.site_dict = self.site.to_dict()
+        self.posts = []
+        self.post_dicts = []
+        self.cursors = []
+        posts = models.Post.select(models.Post, models.User).join(models.User).where(
+            models.Post.site == self.site).order_by(
+            models.Post.created_date.desc(), models.Post.id.desc())
+        for post in posts:
+            post.site = self.site
+            self.posts.append(post)
+            self.post_dicts.append(post.to_dict())
+            self.cursors.append((post.created_date, post.id))
+
+    def posts_by_tag(self):
+        tags = collections.OrderedDict()
+        for post, post_dict, cursor in zip(self.posts, self.post_dicts, self.cursors):
+            for tag in post.tags:
+                post_dicts, cursors = tags.setdefault(tag, ([], []))
+                post_dicts.append(post_dict)
+                cursors.append(cursor)
+        return tags
+
+    def posts_by_author(self):
+        authors = collections.OrderedDict()
+        for post, post_dict, cursor in zip(self.posts, self.post_dicts, self.cursors):
+            author, post_dicts, cursors = authors.setdefault(
+                post.author.uuid, (post.author, [], []))
+            post_dicts.append(post_dict)
+            cursors.append(cursor)
+        return authors
+
+
+def remove_legacy_state(uuid):
+    """Deletes the manifest older renders kept in the served site directory.
+    Stale page cursors in listing directories go with the next full render's
+    prune."""
+    for file_name in LEGACY_STATE_FILES:
+        try:
+            os.remove(os.path.join(get_site_path(uuid), file_name))
+        except OSError:
+            pass
+
+
+@stats.timed
+def render_site(uuid):
+    """Renders every output of a site from a single SiteSnapshot."""
+    logger.info("render.render_site(" + uuid + ")")
+    snapshot = SiteSnapshot(uuid)
+    site, site_dict, template = snapshot.site, snapshot.site_dict, snapshot.template
+    initialize_site_dirs(uuid)
+    remove_legacy_state(uuid)
+    manifest = OutputManifest(uuid, preload=True)
+    for post_dict in snapshot.post_dicts:
+        manifest.write(get_post_path(uuid, post_dict['slug']),
+                       render_template(template, site=site_dict, post=post_dict))
+    manifest.prune(get_site_post_path(uuid))
+    paginate_post_dicts(get_site_archive_path(uuid), snapshot.post_dicts,
+                        site_dict, template, "Archive", manifest, snapshot.cursors)
+    posts_by_tag = snapshot.posts_by_tag()
+    for tag, (post_dicts, cursors) in posts_by_tag.items():
+        dir_path = get_site_tag_path(uuid, tag)
+        politely_make_dir(dir_path)
+        # The tag index copies each post's created_date, so the post cursors
+        # are the tag pages' cursors too.
+        paginate_post_dicts(dir_path, post_dicts, site_dict, template,
+                            "Posts Tagged With " + tag, manifest, cursors)
+    manifest.prune_dirs(get_site_tags_path(uuid), posts_by_tag)
+    posts_by_author = snapshot.posts_by_author()
+    for user_uuid, (user, post_dicts, cursors) in posts_by_author.items():
+        dir_path = get_site_user_path(uuid, user_uuid)
+        politely_make_dir(dir_path)
+        paginate_post_dicts(dir_path, post_dicts, site_dict, template,
+                            "Posts By " + user.public_name, manifest, cursors)
+    manifest.prune_dirs(get_site_users_path(uuid), posts_by_author)
+    manifest.write(get_site_index_path(uuid), render_template(
+        template, site=site_dict, posts=snapshot.post_dicts[:config.PAGE_ITEM_LIMIT],
+        current_page=1, total_pages=count_pages(len(snapshot.post_dicts))))
+    write_rss_feed(manifest, site, snapshot.posts[:config.RSS_ITEM_LIMIT])
+    write_sitemaps(manifest, site, ((post.slug, post.created_date)
+                                    for post in reversed(snapshot.posts)))
+    manifest.write(get_site_robots_txt_path(uuid), build_robots_txt(site))
+    return manifest.save()
 
 ####################################################
 # Tests
 ####################################################
 
 
-def create_dummy_data():
-    user = models.create_dummy_user()
-    user.save()
-    site = models.create_dummy_site(user)
-    site.save()
-    theme = models.create_dummy_theme(site)
-    theme.save()
-    posts = []
-    for k in range(50):
-        post = models.Post()
-        post.dummy(site, user)
-        post.save()
-        posts.append(post)
+def create_dummy_data(post_count=50):
+    ((site_id, user_id),) = models.load_dummy_data(users=1, posts_per_site=post_count)
+    user = models.User.get(models.User.id == user_id)
+    site = models.Site.get(models.Site.id == site_id)
+    posts = list(models.Post.select().where(models.Post.site == site).order_by(
+        models.Post.created_date.desc()))
     return user, site, posts
 
 
@@ -402,6 +1302,9 @@ class RenderTest(unittest.TestCase):
     def setUp(self):
         models.reset_db()
         build_render_workspace()
+        template_cache.clear()
+        rss_item_cache.clear()
+        site_cache.clear()
 
     def tearDown(self):
         clear_render_workspace()
@@ -431,6 +1334,27 @@ class RenderTest(unittest.TestCase):
         self.assertTrue(os.path.isfile(get_site_rss_path(site.uuid)))
         parsed_feed = feedparser.parse(get_site_rss_path(site.uuid))
         self.assertEqual(parsed_feed.feed.title, site.title)
+        self.assertEqual(len(parsed_feed.entries), config.RSS_ITEM_LIMIT)
+
+    def test_Site_RSS_Tiebreak(self):
+        # render_site and generate_site_rss_feed pick the same feed when
+        # posts were created at the same moment.
+        user, site, posts = create_dummy_data()
+        models.Post.update(created_date=datetime.datetime(2015, 1, 1)).where(
+            models.Post.site == site).execute()
+        render_site(site.uuid)
+        self.assertEqual(generate_site_rss_feed(site.uuid)["written"], 0)
+
+    def test_Site_RSS_Unchanged(self):
+        user, site, posts = create_dummy_data()
+        initialize_site(site.uuid)
+        generate_site_rss_feed(site.uuid)
+        self.assertEqual(generate_site_rss_feed(site.uuid)["written"], 0)
+        post = models.Post()
+        post.dummy(site, user)
+        post.save()
+        self.assertEqual(generate_site_rss_feed(site.uuid)["written"], 1)
+        self.assertEqual(rss_item_cache.misses, config.RSS_ITEM_LIMIT + 1)
 
     def test_Site_Sitemap(self):
         user, site, posts = create_dummy_data()
@@ -438,6 +1362,26 @@ class RenderTest(unittest.TestCase):
         generate_site_sitemap(site.uuid)
         self.assertTrue(os.path.isfile(get_site_sitemap_path(site.uuid)))
 
+    def test_Site_Sitemap_Chunks(self):
+        global SITEMAP_URL_LIMIT
+        SITEMAP_URL_LIMIT = 20
+        try:
+            user, site, posts = create_dummy_data()
+            initialize_site(site.uuid)
+            generate_site_sitemap(site.uuid)
+            urls = 0
+            for number in (1, 2, 3):
+                chunk_file = gzip.open(get_site_sitemap_chunk_path(site.uuid, number))
+                urls += chunk_file.read().count("<url>")
+                chunk_file.close()
+            self.assertEqual(urls, len(posts))
+            self.assertFalse(os.path.isfile(get_site_sitemap_chunk_path(site.uuid, 4)))
+            with open(get_site_sitemap_path(site.uuid)) as index_file:
+                self.assertEqual(index_file.read().count("<sitemap>"), 3)
+            self.assertEqual(generate_site_sitemap(site.uuid)["written"], 0)
+        finally:
+            SITEMAP_URL_LIMIT = 50000
+
     def test_Post(self):
         user, site, posts = create_dummy_data()
         post = posts[0]
@@ -445,6 +1389,14 @@ class RenderTest(unittest.TestCase):
         generate_post(post.uuid)
         self.assertTrue(os.path.isfile(get_post_path(site.uuid, post.slug)))
 
+    def test_Post_Batch(self):
+        user, site, posts = create_dummy_data()
+        initialize_site(site.uuid)
+        counts = generate_posts(site.uuid, [post.uuid for post in posts[:5]])
+        self.assertEqual(counts["written"], 5)
+        for post in posts[:5]:
+            self.assertTrue(os.path.isfile(get_post_path(site.uuid, post.slug)))
+
     def test_Delete_Post(self):
         user, site, posts = create_dummy_data()
         post = posts[0]
@@ -468,6 +1420,102 @@ class RenderTest(unittest.TestCase):
             get_site_archive_path(site.uuid), "2.html")
         self.assertTrue(os.path.isfile(page_two_path))
 
+    def test_Archive_Page_Count(self):
+        user, site, posts = create_dummy_data()
+        initialize_site(site.uuid)
+        generate_archives(site.uuid)
+        archive_path = get_site_archive_path(site.uuid)
+        last_page = int(math.ceil(float(len(posts)) / config.PAGE_ITEM_LIMIT))
+        self.assertTrue(os.path.isfile(
+            os.path.join(archive_path, str(last_page) + ".html")))
+        self.assertFalse(os.path.isfile(
+            os.path.join(archive_path, str(last_page + 1) + ".html")))
+
+    def test_Manifest_Skips_Unchanged(self):
+        user, site, posts = create_dummy_data()
+        initialize_site(site.uuid)
+        first_run = generate_archives(site.uuid)
+        self.assertTrue(first_run["written"] > 0)
+        second_run = generate_archives(site.uuid)
+        self.assertEqual(second_run["written"], 0)
+        self.assertEqual(second_run["skipped"], first_run["written"])
+        for post in posts[:config.PAGE_ITEM_LIMIT]:
+            post.delete_instance()
+        third_run = generate_archives(site.uuid)
+        self.assertEqual(third_run["deleted"], 1)
+
+    def test_Failed_Write_Removes_Temp_File(self):
+        user, site, posts = create_dummy_data()
+        initialize_site(site.uuid)
+        dir_path = get_site_archive_path(site.uuid)
+        politely_make_dir(dir_path)
+        # Renaming a file over a directory fails after the temp file is written.
+        path = os.path.join(dir_path, "taken")
+        politely_make_dir(path)
+        self.assertRaises(OSError, write_file_atomically, path, "content")
+        source_path = os.path.join(dir_path, "source.html")
+        write_file_atomically(source_path, "content")
+        self.assertRaises(OSError, link_file_atomically, source_path, path)
+        self.assertEqual(sorted(os.listdir(dir_path)), ["source.html", "taken"])
+
+    def test_Archive_Index_Link(self):
+        user, site, posts = create_dummy_data()
+        initialize_site(site.uuid)
+        generate_archives(site.uuid)
+        archive_path = get_site_archive_path(site.uuid)
+        page_one = os.stat(os.path.join(archive_path, "1.html"))
+        index = os.stat(os.path.join(archive_path, "index.html"))
+        self.assertEqual(page_one.st_ino, index.st_ino)
+
+    def test_Stable_Archive(self):
+        global STABLE_PAGINATION
+        STABLE_PAGINATION = True
+        try:
+            user, site, posts = create_dummy_data()
+            initialize_site(site.uuid)
+            generate_archives(site.uuid)
+            archive_path = get_site_archive_path(site.uuid)
+            newest_page = len(posts) // config.PAGE_ITEM_LIMIT
+            newest_page_path = os.path.join(
+                archive_path, str(newest_page) + ".html")
+            self.assertEqual(
+                os.stat(newest_page_path).st_ino,
+                os.stat(os.path.join(archive_path, "index.html")).st_ino)
+            post = models.Post()
+            post.dummy(site, user)
+            post.save()
+            counts = generate_archives(site.uuid, newest_only=True)
+            # The old newest page, now linking on to the new page, the new
+            # page and its index.html link.
+            self.assertEqual(counts["written"], 3)
+            self.assertTrue(os.path.isfile(os.path.join(
+                archive_path, str(newest_page + 1) + ".html")))
+        finally:
+            STABLE_PAGINATION = False
+
+    def test_Stable_Archive_New_Pages(self):
+        global STABLE_PAGINATION
+        STABLE_PAGINATION = True
+        try:
+            user, site, posts = create_dummy_data()
+            initialize_site(site.uuid)
+            generate_archives(site.uuid)
+            for i in range(config.PAGE_ITEM_LIMIT + 1):
+                post = models.Post()
+                post.dummy(site, user)
+                post.save()
+                posts.append(post)
+            generate_archives(site.uuid, newest_only=True)
+            archive_path = get_site_archive_path(site.uuid)
+            rendered = ""
+            for page in range(1, count_pages(len(posts)) + 1):
+                with open(os.path.join(archive_path, str(page) + ".html")) as page_file:
+                    rendered += page_file.read().decode("utf-8")
+            for post in posts:
+                self.assertIn(post.title, rendered)
+        finally:
+            STABLE_PAGINATION = False
+
     def test_Delete_Archive(self):
         user, site, posts = create_dummy_data()
         initialize_site(site.uuid)
@@ -478,6 +1526,161 @@ class RenderTest(unittest.TestCase):
         delete_archives(site.uuid)
         self.assertFalse(os.path.isfile(page_two_path))
 
+    def test_Seek_Archive_Page(self):
+        user, site, posts = create_dummy_data()
+        initialize_site(site.uuid)
+        generate_archives(site.uuid)
+        self.assertEqual(generate_archives(site.uuid, page=3)["written"], 0)
+        post = posts[2 * config.PAGE_ITEM_LIMIT]
+        post.title = "Retitled Post"
+        post.save()
+        with stats.measure("test", "seek") as measurement:
+            counts = generate_archives(site.uuid, page=3)
+        # Only page 3 is rendered.
+        self.assertEqual(counts, {"written": 1, "skipped": 0, "deleted": 0})
+        self.assertLessEqual(measurement.counters["db_queries"], 3)
+        page_path = os.path.join(get_site_archive_path(site.uuid), "3.html")
+        with open(page_path, "rb") as file_object:
+            self.assertIn("Retitled Post", file_object.read())
+
+    def test_Seek_Stable_Archive_Page(self):
+        global STABLE_PAGINATION
+        STABLE_PAGINATION = True
+        try:
+            user, site, posts = create_dummy_data()
+            render_site(site.uuid)
+            self.assertEqual(generate_archives(site.uuid, page=2)["written"], 0)
+            self.assertEqual(generate_user_pages(site.uuid, user.uuid, page=2)["written"], 0)
+        finally:
+            STABLE_PAGINATION = False
+
+    def test_Seek_Tag_Page(self):
+        user, site, posts = create_dummy_data()
+        initialize_site(site.uuid)
+        tag = posts[0].tags[0]
+        generate_tag_pages(site.uuid, tag)
+        self.assertEqual(generate_tag_pages(site.uuid, tag, page=1)["written"], 0)
+        self.assertEqual(sorted(load_page_cursors(get_site_tag_path(site.uuid, tag))), [1])
+
+    def test_Render_Site_Tag_Cursors(self):
+        user, site, posts = create_dummy_data()
+        render_site(site.uuid)
+        self.assertEqual(generate_tag_pages(site.uuid, "tag")["written"], 0)
+        self.assertEqual(generate_tag_pages(site.uuid, "tag", page=2)["written"], 0)
+
+    def test_Find_Cursor_Page(self):
+        global STABLE_PAGINATION
+        user, site, posts = create_dummy_data()
+        archive_path = get_site_archive_path(site.uuid)
+        try:
+            for stable in (False, True):
+                STABLE_PAGINATION = stable
+                generate_archives(site.uuid)
+                # Stable pages are filled oldest first.
+                ordered_posts = posts[::-1] if stable else posts
+                for i, post in enumerate(ordered_posts):
+                    self.assertEqual(find_cursor_page(archive_path, (post.created_date, post.id)),
+                                     i // config.PAGE_ITEM_LIMIT + 1)
+        finally:
+            STABLE_PAGINATION = False
+
+    def test_Template_Cache(self):
+        user, site, posts = create_dummy_data()
+        initialize_site(site.uuid)
+        generate_archives(site.uuid)
+        generate_index(site.uuid)
+        self.assertEqual(template_cache.misses, 1)
+        self.assertTrue(template_cache.hits > 0)
+        theme = models.Theme.select().where(models.Theme.site == site).get()
+        invalidate_theme_template(theme.uuid)
+        self.assertEqual(template_cache.stats()["size"], 0)
+
+    def test_Render_Site(self):
+        user, site, posts = create_dummy_data()
+        counts = render_site(site.uuid)
+        self.assertTrue(counts["written"] > len(posts))
+        self.assertTrue(os.path.isfile(get_post_path(site.uuid, posts[0].slug)))
+        self.assertTrue(os.path.isfile(get_site_index_path(site.uuid)))
+        self.assertTrue(os.path.isfile(get_site_rss_path(site.uuid)))
+        self.assertTrue(os.path.isfile(get_site_sitemap_path(site.uuid)))
+        self.assertTrue(os.path.isfile(get_site_robots_txt_path(site.uuid)))
+        self.assertTrue(os.path.isfile(os.path.join(
+            get_site_archive_path(site.uuid), "2.html")))
+        self.assertTrue(os.path.isfile(os.path.join(
+            get_site_tag_path(site.uuid, "tag"), "2.html")))
+        self.assertTrue(os.path.isfile(os.path.join(
+            get_site_user_path(site.uuid, user.uuid), "2.html")))
+        self.assertEqual(render_site(site.uuid)["written"], 0)
+
+    def test_Render_Site_Removes_Stale_Listings(self):
+        user, site, posts = create_dummy_data()
+        render_site(site.uuid)
+        manifest = OutputManifest(site.uuid)
+        for dir_path in (get_site_tag_path(site.uuid, "gone"),
+                         get_site_user_path(site.uuid, "gone")):
+            politely_make_dir(dir_path)
+            manifest.write(os.path.join(dir_path, "1.html"), "stale")
+        manifest.save()
+        counts = render_site(site.uuid)
+        self.assertEqual(counts["deleted"], 2)
+        self.assertFalse(os.path.exists(get_site_tag_path(site.uuid, "gone")))
+        self.assertFalse(os.path.exists(get_site_user_path(site.uuid, "gone")))
+        self.assertTrue(os.path.isdir(get_site_tag_path(site.uuid, "tag")))
+        self.assertTrue(os.path.isdir(get_site_user_path(site.uuid, user.uuid)))
+        self.assertNotIn(os.path.join("tag", "gone", "1.html"), OutputManifest(site.uuid).load())
+        self.assertFalse(os.path.exists(get_state_path(get_site_tag_path(site.uuid, "gone"))))
+
+    def test_Tag_Pages_Tiebreak(self):
+        # Posts created at the same moment are ordered by post id, whichever
+        # order their tag rows were inserted in.
+        user, site, posts = create_dummy_data()
+        for post in sorted(posts, key=lambda post: post.id, reverse=True):
+            post.created_date = datetime.datetime(2015, 1, 1)
+            post.save()
+        render_site(site.uuid)
+        dir_path = get_site_tag_path(site.uuid, "tag")
+        page_names = sorted(name for name in os.listdir(dir_path) if name.endswith(".html"))
+
+        def read_pages():
+            pages = []
+            for name in page_names:
+                with open(os.path.join(dir_path, name), "rb") as file_object:
+                    pages.append(file_object.read())
+            return pages
+        rendered = read_pages()
+        generate_tag_pages(site.uuid, "tag")
+        self.assertEqual(read_pages(), rendered)
+
+    def test_Render_State_Outside_Site(self):
+        user, site, posts = create_dummy_data()
+        site_path = get_site_path(site.uuid)
+        initialize_site_dirs(site.uuid)
+        with open(os.path.join(site_path, ".manifest.json"), "wb") as file_object:
+            file_object.write("{}")
+        render_site(site.uuid)
+        for dir_path, dir_names, file_names in os.walk(site_path):
+            self.assertNotIn(".manifest.json", file_names)
+            self.assertNotIn(".pages.json", file_names)
+        self.assertTrue(os.path.isfile(get_site_manifest_path(site.uuid)))
+        self.assertTrue(os.path.isfile(get_page_cursors_path(get_site_archive_path(site.uuid))))
+        # A single post looks up and writes only its own entry.
+        manifest = OutputManifest(site.uuid)
+        manifest.write(get_post_path(site.uuid, posts[0].slug), "changed")
+        self.assertEqual(manifest.hashes.keys(), [manifest.key(get_post_path(site.uuid, posts[0].slug))])
+        manifest.save()
+        self.assertEqual(render_site(site.uuid)["written"], 1)
+
+    def test_Render_Empty_Site(self):
+        import feedparser
+        ((site_id, user_id),) = models.load_dummy_data(users=1, posts_per_site=0)
+        site = models.Site.get(models.Site.id == site_id)
+        render_site(site.uuid)
+        parsed_feed = feedparser.parse(get_site_rss_path(site.uuid))
+        self.assertEqual(parsed_feed.feed.title, site.title)
+        self.assertEqual(len(parsed_feed.entries), 0)
+        self.assertTrue(os.path.isfile(get_site_index_path(site.uuid)))
+        self.assertEqual(render_site(site.uuid)["written"], 0)
+
     def test_Site_User(self):
         user, site, posts = create_dummy_data()
         initialize_site(site.uuid)
@@ -510,5 +1713,70 @@ class RenderTest(unittest.TestCase):
         generate_robot_txt(site.uuid)
         self.assertTrue(os.path.isfile(get_site_robots_txt_path(site.uuid)))
 
+    def test_Site_Cache(self):
+        user, site, posts = create_dummy_data(1)
+        cached_site, theme = get_site_theme(site.uuid)
+        self.assertEqual(cached_site.owner.uuid, user.uuid)
+        self.assertTrue(get_site_theme_by_id(site.id)[0] is cached_site)
+        self.assertTrue(get_site_theme_by_domain(site.domain)[0] is cached_site)
+        self.assertEqual(site_cache.stats()["hits"], 2)
+        site.domain = "changed.example.com"
+        site.save()
+        self.assertEqual(get_site(site.uuid).domain, "changed.example.com")
+        theme.template = "{{ site.title }}"
+        theme.save()
+        self.assertEqual(get_site_theme(site.uuid)[1].template, "{{ site.title }}")
+
+    def test_TTL_Cache(self):
+        cache = TTLCache(2, -1)
+        cache.put("key", "value")
+        self.assertEqual(cache.get("key"), None)
+        self.assertEqual(cache.stats()["misses"], 1)
+        self.assertEqual(cache.stats()["size"], 0)
+        cache = TTLCache(2, 60)
+        cache.put("key", "value")
+        self.assertEqual(cache.get("key"), "value")
+        self.assertEqual(cache.stats()["hit_rate"], 1.0)
+
+    ####################################################
+    # Query Budgets
+    ####################################################
+    def count_queries(self, post_count):
+        """Runs each generator on a fresh site with a cold site cache.
+
+        Returns:
+                Dictionary of generator name to queries run.
+        """
+        models.reset_db()
+        user, site, posts = create_dummy_data(post_count)
+        initialize_site(site.uuid)
+        calls = [
+            ("render_site", lambda: render_site(site.uuid)),
+            ("generate_archives", lambda: generate_archives(site.uuid)),
+            ("generate_index", lambda: generate_index(site.uuid)),
+            ("generate_post", lambda: generate_post(posts[0].uuid)),
+            ("generate_posts", lambda: generate_posts(site.uuid, [post.uuid for post in posts])),
+            ("generate_robot_txt", lambda: generate_robot_txt(site.uuid)),
+            ("generate_site_rss_feed", lambda: generate_site_rss_feed(site.uuid)),
+            ("generate_site_sitemap", lambda: generate_site_sitemap(site.uuid)),
+            ("generate_tag_pages", lambda: generate_tag_pages(site.uuid, "tag")),
+            ("generate_user_pages", lambda: generate_user_pages(site.uuid, user.uuid)),
+        ]
+        counts = {}
+        for name, call in calls:
+            site_cache.clear()
+            with stats.measure("test", name) as measurement:
+                call()
+            counts[name] = measurement.counters["db_queries"]
+        return counts
+
+    def test_Query_Budgets(self):
+        counts = self.count_queries(10)
+        self.assertEqual(set(counts), set(QUERY_BUDGETS))
+        for name, count in counts.items():
+            self.assertLessEqual(count, QUERY_BUDGETS[name], "%s ran %d queries, budget %d" % (
+                name, count, QUERY_BUDGETS[name]))
+        self.assertEqual(self.count_queries(1000), counts)
+
 if __name__ == '__main__':
     unittest.main()
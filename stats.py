@@ -0,0 +1,274 @@
+# -*- coding: utf-8 -*-
+"""Render instrumentation.
+
+Tasks and render generators are measured for wall time, database queries
+and query time, template render time, and bytes and files written. Totals
+are kept per task or generator name and per site, flushed to a Prometheus
+text file every STATS_FLUSH_INTERVAL seconds, and summarized in the log.
+"""
+import collections
+import contextlib
+import functools
+import logging
+import os
+import threading
+import time
+import unittest
+
+import config
+
+
+logger = logging.getLogger(__name__)
+
+STATS_DIRECTORY = getattr(config, "STATS_DIRECTORY", ".")
+STATS_FLUSH_INTERVAL = getattr(config, "STATS_FLUSH_INTERVAL", 60)
+
+COUNTERS = ("calls", "seconds", "db_queries", "db_seconds", "template_seconds",
+            "bytes_written", "files_written")
+
+HELP = {
+    "calls": "Number of runs.",
+    "seconds": "Wall time spent.",
+    "db_queries": "Database queries executed.",
+    "db_seconds": "Time spent in database queries.",
+    "template_seconds": "Time spent rendering templates.",
+    "bytes_written": "Bytes written to rendered files.",
+    "files_written": "Rendered files written.",
+}
+
+
+####################################################
+# Measurements
+####################################################
+
+
+class Measurement(object):
+    """Counters for one running task or generator."""
+
+    def __init__(self, kind, name, site_uuid=None):
+        self.kind = kind
+        self.name = name
+        self.site_uuid = site_uuid
+        self.started = time.time()
+        self.counters = dict.fromkeys(COUNTERS, 0)
+        self.counters["calls"] = 1
+
+
+class Aggregator(object):
+    """Totals by (kind, name) and by site, shared by every thread."""
+
+    def __init__(self):
+        self.by_name = collections.defaultdict(lambda: dict.fromkeys(COUNTERS, 0))
+        self.by_site = collections.defaultdict(lambda: dict.fromkeys(COUNTERS, 0))
+        self.last_flush = time.time()
+        self.lock = threading.Lock()
+
+    def add(self, measurement, outermost):
+        with self.lock:
+            totals = self.by_name[(measurement.kind, measurement.name)]
+            for key, value in measurement.counters.items():
+                totals[key] += value
+            if outermost and measurement.site_uuid:
+                totals = self.by_site[measurement.site_uuid]
+                for key, value in measurement.counters.items():
+                    totals[key] += value
+
+    def clear(self):
+        with self.lock:
+            self.by_name.clear()
+            self.by_site.clear()
+
+
+local = threading.local()
+aggregator = Aggregator()
+caches = {}
+"""Name to an object with a stats() dictionary of hits, misses and size."""
+
+
+def active():
+    if not hasattr(local, "stack"):
+        local.stack = []
+    return local.stack
+
+
+def start(kind, name, site_uuid=None):
+    measurement = Measurement(kind, name, site_uuid)
+    active().append(measurement)
+    return measurement
+
+
+def stop():
+    stack = active()
+    measurement = stack.pop()
+    measurement.counters["seconds"] = time.time() - measurement.started
+    aggregator.add(measurement, not stack)
+    if not stack and time.time() - aggregator.last_flush > STATS_FLUSH_INTERVAL:
+        flush()
+    return measurement
+
+
+def add(**counters):
+    """Adds to every running measurement, so a task includes its generators."""
+    for measurement in active():
+        for key, value in counters.items():
+            measurement.counters[key] += value
+
+
+def set_site(site_uuid):
+    """Attributes the running measurements to a site once it is known."""
+    for measurement in active():
+        if measurement.site_uuid is None:
+            measurement.site_uuid = site_uuid
+
+
+@contextlib.contextmanager
+def measure(kind, name):
+    """Measures a block, e.g. to count the queries a call issues:
+
+        with stats.measure("test", "generate_index") as measurement:
+            render.generate_index(uuid)
+        measurement.counters["db_queries"]
+    """
+    measurement = start(kind, name)
+    try:
+        yield measurement
+    finally:
+        stop()
+
+
+def register_cache(name, cache):
+    """Adds a cache's hit and miss counters to the exported stats."""
+    caches[name] = cache
+
+
+def timed(function):
+    """Measures a render generator under its own name."""
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        start("generator", function.__name__)
+        try:
+            return function(*args, **kwargs)
+        finally:
+            stop()
+    return wrapper
+
+
+def instrument_database(database):
+    """Counts and times every query run through database.execute_sql."""
+    if getattr(database, "stats_instrumented", False):
+        return
+    execute_sql = database.execute_sql
+
+    def timed_execute_sql(*args, **kwargs):
+        started = time.time()
+        try:
+            return execute_sql(*args, **kwargs)
+        finally:
+            add(db_queries=1, db_seconds=time.time() - started)
+    database.execute_sql = timed_execute_sql
+    database.stats_instrumented = True
+
+
+####################################################
+# Export
+####################################################
+
+
+def get_stats_path():
+    return os.path.join(STATS_DIRECTORY, "muckamuck_%d.prom" % os.getpid())
+
+
+def format_prometheus():
+    lines = []
+    pid = os.getpid()
+    with aggregator.lock:
+        for key in COUNTERS:
+            metric = "muckamuck_render_" + key + "_total"
+            lines.append("# HELP %s %s" % (metric, HELP[key]))
+            lines.append("# TYPE %s counter" % metric)
+            for (kind, name), totals in sorted(aggregator.by_name.items()):
+                lines.append('%s{kind="%s",name="%s",pid="%d"} %s' % (
+                    metric, kind, name, pid, totals[key]))
+            for site_uuid, totals in sorted(aggregator.by_site.items()):
+                lines.append('%s{kind="site",name="%s",pid="%d"} %s' % (
+                    metric, site_uuid, pid, totals[key]))
+    cache_stats = sorted((name, cache.stats()) for name, cache in caches.items())
+    for key, kind in (("hits", "counter"), ("misses", "counter"), ("size", "gauge")):
+        metric = "muckamuck_cache_" + key + ("_total" if kind == "counter" else "")
+        lines.append("# TYPE %s %s" % (metric, kind))
+        for name, values in cache_stats:
+            lines.append('%s{cache="%s",pid="%d"} %s' % (metric, name, pid, values[key]))
+    return "\n".join(lines) + "\n"
+
+
+def summarize(limit=5):
+    with aggregator.lock:
+        sites = sorted(aggregator.by_site.items(),
+                       key=lambda item: item[1]["seconds"], reverse=True)[:limit]
+        names = sorted(aggregator.by_name.items(),
+                       key=lambda item: item[1]["seconds"], reverse=True)[:limit]
+    return "render stats slowest: %s | slowest sites: %s | cache hit rates: %s" % (
+        ", ".join("%s %.2fs/%d calls/%d queries" % (name, totals["seconds"], totals["calls"],
+                                                    totals["db_queries"])
+                  for (kind, name), totals in names),
+        ", ".join("%s %.2fs" % (site_uuid, totals["seconds"]) for site_uuid, totals in sites),
+        ", ".join("%s %.0f%%" % (name, cache.stats()["hit_rate"] * 100)
+                  for name, cache in sorted(caches.items())))
+
+
+def flush():
+    """Rewrites this process's stats file and logs a summary line."""
+    aggregator.last_flush = time.time()
+    path = get_stats_path()
+    temp_path = path + ".tmp"
+    try:
+        with open(temp_path, "wb") as file_object:
+            file_object.write(format_prometheus())
+        os.rename(temp_path, path)
+    except (IOError, OSError):
+        logger.exception("stats.flush could not write " + path)
+    logger.info(summarize())
+
+
+####################################################
+# Tests
+####################################################
+
+
+class StatsTest(unittest.TestCase):
+
+    def setUp(self):
+        aggregator.clear()
+
+    def test_Nested_Measurements(self):
+        start("task", "render_archive")
+        start("generator", "generate_archives")
+        set_site("site")
+        add(db_queries=2, files_written=1)
+        stop()
+        stop()
+        self.assertEqual(aggregator.by_name[("task", "render_archive")]["db_queries"], 2)
+        self.assertEqual(aggregator.by_name[("generator", "generate_archives")]["files_written"], 1)
+        self.assertEqual(aggregator.by_site["site"]["calls"], 1)
+        self.assertEqual(aggregator.by_site["site"]["db_queries"], 2)
+
+    def test_Timed(self):
+        @timed
+        def generate_nothing():
+            add(bytes_written=10)
+        generate_nothing()
+        self.assertEqual(aggregator.by_name[("generator", "generate_nothing")]["bytes_written"], 10)
+        self.assertIn('name="generate_nothing"', format_prometheus())
+
+    def test_Measure(self):
+        with measure("test", "block") as measurement:
+            add(db_queries=3)
+        self.assertEqual(measurement.counters["db_queries"], 3)
+
+    def test_Add_Outside_Measurement(self):
+        add(db_queries=1)
+        self.assertEqual(len(aggregator.by_name), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,12 +1,22 @@
-from celery import Celery
+from celery import Celery, current_task
+from celery.signals import task_postrun, task_prerun
+from celery.signals import worker_process_init, worker_process_shutdown
+import functools
+import json
 import logging
 import logging.handlers
 import os
+import redis
+import threading
+import time
 import unittest
 
 
+import config
 import models
+import planner
 import render
+import stats
 
 
 #/home/jason/Desktop/muckamuck_shit
@@ -32,35 +42,447 @@ logger.addHandler(file_handle)
 BROKER_URL = 'redis://localhost:6379/0'
 app = Celery('tasks', broker=BROKER_URL)
 
+INTERACTIVE_QUEUE = 'interactive'
+BULK_QUEUE = 'bulk'
+INTERACTIVE_TASKS = ['new_post', 'render_post', 'render_index', 'change_domain']
+BULK_TASKS = ['full_rerender', 'render_all_posts', 'render_posts', 'render_all_tags',
+              'render_all_users', 'reindex_tags']
+"""Publish-to-live work goes to the interactive queue so a bulk rebuild never
+sits in front of it. Everything else stays on the default queue. Run
+dedicated pools with, e.g.:
+
+    celery -A tasks worker -Q interactive
+    celery -A tasks worker -Q celery,bulk
+"""
+routes = {}
+for task_name in INTERACTIVE_TASKS:
+    routes['tasks.' + task_name] = {'queue': INTERACTIVE_QUEUE}
+for task_name in BULK_TASKS:
+    routes['tasks.' + task_name] = {'queue': BULK_QUEUE}
+app.conf.CELERY_ROUTES = routes
+
+POST_CHUNK_SIZE = getattr(config, "POST_CHUNK_SIZE", 100)
+"""Post pages rendered per render_posts task by render_all_posts."""
+
+COALESCE_WINDOW = getattr(config, "COALESCE_WINDOW", 5)
+"""Seconds a site's listing renders wait for more events before running."""
+
+DEBOUNCED_TARGETS = set([planner.TAG, planner.USER, planner.ARCHIVE, planner.INDEX,
+                         planner.RSS, planner.SITEMAP, planner.ROBOTS, planner.ALL_POSTS,
+                         planner.ALL_TAGS, planner.ALL_USERS])
+"""Planner target kinds that are coalesced per site rather than run per event."""
+
+SITE_CHANGES_CHANNEL = "muckamuck:site_changes"
+"""Redis channel carrying the ids of saved sites, so every worker process
+drops them from render.site_cache."""
+
+DEDUP_CLAIM_TIMEOUT = getattr(config, "DEDUP_CLAIM_TIMEOUT", 600)
+"""Seconds a running render holds its claim if the worker dies mid-task."""
+
+DEDUP_TTL = getattr(config, "DEDUP_TTL", 3600)
+"""Seconds a completed render version is remembered. Matches the Redis
+transport's default visibility timeout, after which messages are redelivered."""
+
+####################################################
+# Worker Lifecycle
+####################################################
+@worker_process_init.connect
+def open_worker_pool(**kwargs):
+    """Drops pooled connections inherited from the parent and warms one."""
+    models.db.reset_after_fork()
+    with models.connection():
+        pass
+    listener = threading.Thread(target=listen_for_site_changes, name="site-changes")
+    listener.daemon = True
+    listener.start()
+
+@worker_process_shutdown.connect
+def close_worker_pool(**kwargs):
+    models.db.close_all()
+    stats.flush()
+
+@task_prerun.connect
+def start_task_stats(task=None, **kwargs):
+    stats.start("task", task.name.rsplit('.', 1)[-1])
+
+@task_postrun.connect
+def stop_task_stats(task=None, **kwargs):
+    stats.stop()
+
+####################################################
+# Coalescing
+####################################################
+class RedisDirtyStore(object):
+    """Per-site pending render targets, shared by every worker through Redis."""
+
+    def __init__(self, client, prefix="muckamuck:dirty:"):
+        self.client = client
+        self.prefix = prefix
+
+    def mark(self, uuid, targets, window):
+        """Adds targets to the site's pending set.
+
+        Returns:
+                True if this call opened the window and must schedule the flush.
+        """
+        key = self.prefix + uuid
+        pipe = self.client.pipeline()
+        pipe.sadd(key, *[json.dumps(target) for target in targets])
+        pipe.set(key + ":scheduled", "1", ex=window * 10, nx=True)
+        return bool(pipe.execute()[1])
+
+    def take(self, uuid):
+        """Atomically reads and clears the site's pending set."""
+        key = self.prefix + uuid
+        pipe = self.client.pipeline()
+        pipe.smembers(key)
+        pipe.delete(key, key + ":scheduled")
+        members = pipe.execute()[0]
+        return set(tuple(json.loads(member)) for member in members)
+
+
+class MemoryDirtyStore(object):
+    """In-process stand-in for RedisDirtyStore, for tests and eager mode."""
+
+    def __init__(self):
+        self.pending = {}
+        self.lock = threading.Lock()
+
+    def mark(self, uuid, targets, window):
+        with self.lock:
+            opened = uuid not in self.pending
+            self.pending.setdefault(uuid, set()).update(targets)
+            return opened
+
+    def take(self, uuid):
+        with self.lock:
+            return self.pending.pop(uuid, set())
+
+
+redis_client = redis.StrictRedis.from_url(BROKER_URL)
+dirty_store = RedisDirtyStore(redis_client)
+
+####################################################
+# Site Cache Invalidation
+####################################################
+def publish_site_change(instance):
+    """models.save_listeners hook: tells every worker a site or theme changed."""
+    if isinstance(instance, models.Site):
+        site_id = instance.id
+    elif isinstance(instance, models.Theme):
+        site_id = instance._data.get("site")
+    else:
+        return
+    if site_id is None:
+        return
+    try:
+        redis_client.publish(SITE_CHANGES_CHANNEL, site_id)
+    except redis.RedisError:
+        logger.exception('tasks.publish_site_change(' + str(site_id) + ') failed')
+
+models.save_listeners.append(publish_site_change)
+
+def listen_for_site_changes():
+    """Runs in each worker process, dropping changed sites from its cache.
+    After a lost connection the whole cache is dropped, since changes may
+    have been missed.
+    """
+    while True:
+        try:
+            pubsub = redis_client.pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(SITE_CHANGES_CHANNEL)
+            render.site_cache.clear()
+            for message in pubsub.listen():
+                try:
+                    site_id = int(message['data'])
+                except (TypeError, ValueError):
+                    logger.error('tasks.listen_for_site_changes ignored ' + repr(message['data']))
+                    continue
+                render.invalidate_site(site_id=site_id)
+        except redis.RedisError:
+            logger.exception('tasks.listen_for_site_changes lost its connection')
+            time.sleep(1)
+
+####################################################
+# Deduplication
+####################################################
+class RedisDedupStore(object):
+    """Which version of each render target is running or last completed."""
+
+    def __init__(self, client, prefix="muckamuck:dedup:"):
+        self.client = client
+        self.prefix = prefix
+
+    def claim(self, target, version, timeout):
+        """Returns:
+                True if the caller should render, False if this version is
+                already running or was the last one completed.
+        """
+        key = self.prefix + target
+        if not self.client.set(key + ":running:" + version, "1", ex=timeout, nx=True):
+            return False
+        if self.client.get(key + ":done") == version:
+            self.client.delete(key + ":running:" + version)
+            return False
+        return True
+
+    def complete(self, target, version, ttl):
+        key = self.prefix + target
+        pipe = self.client.pipeline()
+        pipe.set(key + ":done", version, ex=ttl)
+        pipe.delete(key + ":running:" + version)
+        pipe.execute()
+
+    def release(self, target, version):
+        """Drops a claim after a failure so a retry can run."""
+        self.client.delete(self.prefix + target + ":running:" + version)
+
+
+class MemoryDedupStore(object):
+    """In-process stand-in for RedisDedupStore. Entries do not expire."""
+
+    def __init__(self):
+        self.running = set()
+        self.done = {}
+        self.lock = threading.Lock()
+
+    def claim(self, target, version, timeout):
+        with self.lock:
+            if (target, version) in self.running or self.done.get(target) == version:
+                return False
+            self.running.add((target, version))
+            return True
+
+    def complete(self, target, version, ttl):
+        with self.lock:
+            self.running.discard((target, version))
+            self.done[target] = version
+
+    def release(self, target, version):
+        with self.lock:
+            self.running.discard((target, version))
+
+
+dedup_store = RedisDedupStore(redis_client)
+
+
+def deduplicated(function):
+    """Skips a render whose target and version is running or already done.
+
+    The target is the task name and arguments. The version is the version
+    keyword the dispatcher passed, a fingerprint of the event's content, so
+    duplicate events collapse. Without one, the Celery task id is used, which
+    still collapses broker redeliveries. Rendering always reads the current
+    rows; the version only decides whether to bother.
+    """
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        version = kwargs.pop("version", None)
+        if version is None and current_task and current_task.request.id:
+            version = current_task.request.id
+        if version is None:
+            return function(*args, **kwargs)
+        target = function.__name__ + ":" + render.hash_values(*args + tuple(sorted(kwargs.items())))
+        if not dedup_store.claim(target, version, DEDUP_CLAIM_TIMEOUT):
+            logger.info('tasks.' + function.__name__ + ' skipped duplicate ' + version)
+            return None
+        try:
+            result = function(*args, **kwargs)
+        except Exception:
+            dedup_store.release(target, version)
+            raise
+        dedup_store.complete(target, version, DEDUP_TTL)
+        return result
+    return wrapper
+
+
+def post_version(post, *values):
+    """Content fingerprint of a post event, used as the render version."""
+    return render.hash_values(post.uuid, post.title, post.description, post.body,
+                              post.slug, post.author.uuid, *(list(post.tags) + list(values)))
+
 ####################################################
 # Events
 ####################################################
 @app.task
 def new_post(uuid):
-    models.db.connect()
-    post = models.Post.select().where(models.Post.uuid == uuid).get()
-    render_post.delay(uuid)
-    update_site.delay(post.site.uuid)
-    models.db.close()
+    with models.connection():
+        post = models.Post.select().where(models.Post.uuid == uuid).get()
+        dispatch_plan(post.site.uuid, planner.plan_post_created(
+            uuid, post.author.uuid, post.tags), post_version(post))
+
+@app.task
+def edit_post(uuid, old_tags=None, old_author_uuid=None):
+    """Post.save has already reindexed the post's tags, so the caller passes
+    the tags and author it had before the edit. Those left out are taken
+    to be unchanged.
+    """
+    with models.connection():
+        post = models.Post.select().where(models.Post.uuid == uuid).get()
+        if old_tags is None:
+            old_tags = post.tags
+        if old_author_uuid is None:
+            old_author_uuid = post.author.uuid
+        targets = planner.plan_post_edited(uuid, post.author.uuid, post.tags, old_tags,
+                                           old_author_uuid)
+        # An edit keeps the post's created_date, so in every listing it stays
+        # in only the page holding it changed. Listings it joined or left
+        # are rendered whole.
+        moved = set((planner.TAG, tag, False) for tag in set(post.tags) ^ set(old_tags))
+        if old_author_uuid != post.author.uuid:
+            moved |= set([(planner.USER, post.author.uuid, False),
+                          (planner.USER, old_author_uuid, False)])
+        targets = planner.pin_pages(targets, find_post_pages(
+            post.site.uuid, post, targets - moved))
+        dispatch_plan(post.site.uuid, targets,
+                      post_version(post, old_author_uuid, *old_tags))
+
+@app.task
+def delete_post(site_uuid, uuid, slug, author_uuid, tags):
+    """Called after the row and its tag index rows are gone, so the caller
+    passes what it held.
+    """
+    with models.connection():
+        dispatch_plan(site_uuid, planner.plan_post_deleted(slug, author_uuid, tags),
+                      render.hash_values("deleted", uuid))
+
+@app.task
+def change_tags(uuid, old_tags):
+    """Post.save has already reindexed the post's tags, so the caller passes
+    the tags it had before.
+    """
+    with models.connection():
+        post = models.Post.select().where(models.Post.uuid == uuid).get()
+        dispatch_plan(post.site.uuid, planner.plan_tags_changed(
+            uuid, post.tags, old_tags), post_version(post, *old_tags))
+
+@app.task
+def rename_author(site_uuid, user_uuid):
+    with models.connection():
+        site = models.Site.select().where(models.Site.uuid == site_uuid).get()
+        user = models.User.select().where(models.User.uuid == user_uuid).get()
+        posts = [(post.uuid, post.tags) for post in models.Post.select().where(
+            (models.Post.site == site) & (models.Post.author == user))]
+        dispatch_plan(site_uuid, planner.plan_author_renamed(user_uuid, posts),
+                      render.hash_values(user_uuid, user.public_name))
 
 @app.task
 def new_site(uuid):
-    models.db.connect()
-    site = models.Site.select().where( models.Site.uuid == uuid).get()
-    initialize_site(site.uuid)
-    change_domain.delay(uuid, site.domain)
-    models.db.close()
+    with models.connection():
+        site = models.Site.select().where( models.Site.uuid == uuid).get()
+        initialize_site(site.uuid)
+        change_domain.delay(uuid, site.domain)
 
 @app.task
 def change_domain(uuid, new_domain):
-    models.db.connect()
-    site = models.Site.select().where( models.Site.uuid == uuid).get()
-    old_domain = site.domain
-    render.remove_domain_symlink(uuid)
-    site.domain = new_domain
-    site.save()
-    render.make_domain_symlink(uuid)
-    models.db.close()
+    with models.connection():
+        site = models.Site.select().where( models.Site.uuid == uuid).get()
+        old_domain = site.domain
+        render.remove_domain_symlink(uuid)
+        site.domain = new_domain
+        # Drops the cached site here and, through publish_site_change, in
+        # every other worker.
+        site.save()
+        targets = planner.plan_domain_changed()
+        targets.discard((planner.DOMAIN,))
+        render.make_domain_symlink(uuid)
+        dispatch_plan(uuid, targets, render.hash_values(old_domain, new_domain))
+
+@app.task
+def change_theme(uuid):
+    logger.info('tasks.change_theme('+ uuid +')')
+    with models.connection():
+        site = models.Site.select().where( models.Site.uuid == uuid).get()
+        theme = models.Theme.select().where(models.Theme.site == site).get()
+        render.invalidate_theme_template(theme.uuid)
+        render.invalidate_site(uuid)
+        publish_site_change(theme)
+        dispatch_plan(uuid, planner.plan_theme_changed(), render.hash_template(theme.template))
+
+####################################################
+# Planning
+####################################################
+def dispatch_plan(uuid, targets, version=None):
+    """Runs a planner target set.
+
+    Post pages are enqueued straight away, tagged with the event's content
+    version so duplicate events render them once. Site listings are added to
+    the site's dirty set, and the first event in a COALESCE_WINDOW schedules
+    a single flush_site_updates for all of them.
+    """
+    logger.info('tasks.dispatch_plan('+ uuid +') ' + str(len(targets)) + ' targets')
+    debounced = set(target for target in targets if target[0] in DEBOUNCED_TARGETS)
+    dispatch_targets(uuid, set(targets) - debounced, version)
+    if debounced and dirty_store.mark(uuid, debounced, COALESCE_WINDOW):
+        flush_site_updates.apply_async((uuid,), countdown=COALESCE_WINDOW)
+
+@app.task
+def flush_site_updates(uuid):
+    """Runs a site's coalesced listing renders.
+
+    Any number of post_created events collapse into one newest-only render
+    per listing. That still covers them all: a newest-only render starts at
+    the newest page the listing had when it was last rendered, so it reaches
+    every page the batch filled or added.
+    """
+    logger.info('tasks.flush_site_updates('+ uuid +')')
+    dispatch_targets(uuid, planner.normalize(dirty_store.take(uuid)))
+
+def find_post_pages(uuid, post, targets):
+    """Finds the page showing post in each full listing render of targets.
+
+    Returns:
+            Dictionary of target to page number, for planner.pin_pages.
+            Listings without saved page cursors are left out.
+    """
+    cursor = (post.created_date, post.id)
+    pages = {}
+    for target in targets:
+        if target == (planner.ARCHIVE, False):
+            dir_path = render.get_site_archive_path(uuid)
+        elif target[0] == planner.TAG and target[2:] == (False,):
+            dir_path = render.get_site_tag_path(uuid, target[1])
+        elif target[0] == planner.USER and target[2:] == (False,):
+            dir_path = render.get_site_user_path(uuid, target[1])
+        else:
+            continue
+        page = render.find_cursor_page(dir_path, cursor)
+        if page is not None:
+            pages[target] = page
+    return pages
+
+def dispatch_targets(uuid, targets, version=None):
+    """Enqueues exactly the renders a planner target set asks for."""
+    for target in sorted(targets):
+        kind, args = target[0], target[1:]
+        if kind == planner.POST:
+            render_post.delay(*args, version=version)
+        elif kind == planner.UNPUBLISH:
+            unpublish_post.delay(uuid, *args, version=version)
+        elif kind == planner.TAG:
+            render_tag.delay(uuid, *args)
+        elif kind == planner.USER:
+            render_user.delay(uuid, *args)
+        elif kind == planner.ARCHIVE:
+            render_archive.delay(uuid, *args)
+        elif kind == planner.INDEX:
+            render_index.delay(uuid)
+        elif kind == planner.RSS:
+            render_rss.delay(uuid)
+        elif kind == planner.SITEMAP:
+            render_sitemap.delay(uuid)
+        elif kind == planner.ROBOTS:
+            render_robots.delay(uuid)
+        elif kind == planner.DOMAIN:
+            render.make_domain_symlink(uuid)
+        elif kind == planner.ALL_POSTS:
+            render_all_posts.delay(uuid)
+        elif kind == planner.ALL_TAGS:
+            render_all_tags.delay(uuid)
+        elif kind == planner.ALL_USERS:
+            render_all_users.delay(uuid)
+        else:
+            logger.error('tasks.dispatch_targets unknown target ' + kind)
 
 ####################################################
 # Tasks
@@ -72,92 +494,143 @@ def render_test_task():
 @app.task
 def initialize_site(uuid):
     logger.info('tasks.initialize_site('+ uuid +')')
-    models.db.connect()
-    render.initialize_site(uuid)
-    update_site.delay(uuid)
-    render.generate_robot_txt(uuid)
-    models.db.close()
+    with models.connection():
+        render.initialize_site(uuid)
+        update_site.delay(uuid)
+        render.generate_robot_txt(uuid)
 
 @app.task
-def update_site(uuid):
+def update_site(uuid, newest_only=False):
     logger.info('tasks.update_site('+ uuid +')')
-    render_archive.delay(uuid)
+    render_archive.delay(uuid, newest_only)
     render_index.delay(uuid)
     render_rss.delay(uuid)
     render_sitemap.delay(uuid)
 
 @app.task
+@deduplicated
 def full_rerender(uuid):
     logger.info('tasks.full_rerender('+ uuid +')')
-    update_site.delay(uuid)
-    render_all_tags.delay(uuid)
-    render_all_posts.delay(uuid)
+    with models.connection():
+        render.render_site(uuid)
 
 @app.task
-def render_all_posts(uuid):
+@deduplicated
+def render_all_posts(uuid, chunk_size=None):
     logger.info('tasks.render_all_posts('+ uuid +')')
-    models.db.connect()
-    site = models.Site.select().where( models.Site.uuid == uuid).get()
-    for post in  models.Post.select().where(models.Post.site == site).iterator():
-        render_post.delay(post.uuid)
-    models.db.close()
+    with models.connection():
+        site = models.Site.select().where( models.Site.uuid == uuid).get()
+        post_uuids = models.Post.select(models.Post.uuid).where(
+            models.Post.site == site).tuples().iterator()
+        for chunk in render.chunk_posts(post_uuids, chunk_size or POST_CHUNK_SIZE):
+            render_posts.delay(uuid, [post_uuid for (post_uuid,) in chunk])
+
+@app.task
+@deduplicated
+def render_posts(uuid, post_uuids):
+    logger.info('tasks.render_posts('+ uuid + ',' + str(len(post_uuids)) + ')')
+    with models.connection():
+        render.generate_posts(uuid, post_uuids)
 
 @app.task
+@deduplicated
 def render_post(uuid):
     logger.info('tasks.render_post('+ uuid +')')
-    models.db.connect()
-    render.generate_post(uuid)
-    models.db.close()
+    with models.connection():
+        render.generate_post(uuid)
+
+@app.task
+@deduplicated
+def unpublish_post(uuid, slug):
+    logger.info('tasks.unpublish_post('+ uuid + ',' + slug + ')')
+    render.remove_post(uuid, slug)
 
 
 
 @app.task
+@deduplicated
 def render_all_tags(uuid):
     logger.info('tasks.render_all_tags('+ uuid +')')
-    models.db.connect()
-    tags = models.get_site_tags(uuid)
-    for tag in tags:
-        render_tag.delay(uuid, tag)
-    models.db.close()
+    with models.connection():
+        tags = models.get_site_tags(uuid)
+        for tag in tags:
+            render_tag.delay(uuid, tag)
+
+
+@app.task
+def reindex_tags(uuid):
+    """Backfills the tag index from the posts of a site."""
+    logger.info('tasks.reindex_tags('+ uuid +')')
+    with models.connection():
+        site = models.Site.select().where( models.Site.uuid == uuid).get()
+        for post in models.Post.select().where(models.Post.site == site).iterator():
+            models.set_post_tags(post)
 
 
 @app.task
-def render_tag(uuid, tag):
+@deduplicated
+def render_tag(uuid, tag, newest_only=False, page=None):
     logger.info('tasks.render_tag('+ uuid + ',' + tag + ')')
-    models.db.connect()
-    generate_tag_pages(uuid, tag)
-    models.db.close()
+    with models.connection():
+        render.generate_tag_pages(uuid, tag, newest_only, page)
+
+
+@app.task
+@deduplicated
+def render_all_users(uuid):
+    logger.info('tasks.render_all_users('+ uuid +')')
+    with models.connection():
+        site = models.Site.select().where( models.Site.uuid == uuid).get()
+        authors = models.User.select().join(models.Post, on=models.Post.author).where(
+            models.Post.site == site).distinct()
+        for user in authors:
+            render_user.delay(uuid, user.uuid)
 
 
 @app.task
-def render_archive(uuid):
+@deduplicated
+def render_user(uuid, user_uuid, newest_only=False, page=None):
+    logger.info('tasks.render_user('+ uuid + ',' + user_uuid + ')')
+    with models.connection():
+        render.generate_user_pages(uuid, user_uuid, newest_only, page)
+
+
+@app.task
+@deduplicated
+def render_archive(uuid, newest_only=False, page=None):
     logger.info('tasks.render_archive('+ uuid +')')
-    models.db.connect()
-    render.generate_archives(uuid)
-    models.db.close()
+    with models.connection():
+        render.generate_archives(uuid, newest_only, page)
 
 
 @app.task
+@deduplicated
 def render_index(uuid):
     logger.info('tasks.render_index('+ uuid +')')
-    models.db.connect()
-    render.generate_index(uuid)
-    models.db.close()
+    with models.connection():
+        render.generate_index(uuid)
 
 
 @app.task
+@deduplicated
 def render_rss(uuid):
     logger.info('tasks.render_rss('+ uuid +')')
-    models.db.connect()
-    render.generate_site_rss_feed(uuid)
-    models.db.close()
+    with models.connection():
+        render.generate_site_rss_feed(uuid)
+
+@app.task
+@deduplicated
+def render_robots(uuid):
+    logger.info('tasks.render_robots('+ uuid +')')
+    with models.connection():
+        render.generate_robot_txt(uuid)
 
 @app.task
+@deduplicated
 def render_sitemap(uuid):
     logger.info('tasks.render_sitemap('+ uuid +')')
-    models.db.connect()
-    render.generate_site_sitemap(uuid)
-    models.db.close()
+    with models.connection():
+        render.generate_site_sitemap(uuid)
 
 
 ####################################################
@@ -165,25 +638,16 @@ def render_sitemap(uuid):
 ####################################################
 
 def create_dummy_data():
-    for i in range(5):
-        user = models.create_dummy_user()
-        user.save()
-        for j in range(5):
-            site = models.create_dummy_site(user)
-            site.save()
-            theme = models.create_dummy_theme(site)
-            theme.save()
-            posts = []
-            for k in range(5):
-                post = models.Post()
-                post.dummy(site, user)
-                post.save()
-                posts.append(post)
+    models.load_dummy_data(users=5, sites_per_user=5, posts_per_site=5)
 
 
 class TasksTest(unittest.TestCase):
 
     def setUp(self):
+        global dirty_store, dedup_store
+        dirty_store = MemoryDirtyStore()
+        dedup_store = MemoryDedupStore()
+        render.site_cache.clear()
         render.clear_render_workspace()
         app.conf.CELERY_ALWAYS_EAGER = True
         models.reset_db()
@@ -232,6 +696,79 @@ class TasksTest(unittest.TestCase):
         post_path = render.get_post_path(site.uuid, post.slug)
         self.assertTrue(os.path.isfile( post_path ))
 
+    def test_Coalesced_New_Posts(self):
+        render.STABLE_PAGINATION = True
+        try:
+            site = models.get_random_site()
+            initialize_site(site.uuid)
+            for i in range(config.PAGE_ITEM_LIMIT + 1):
+                post = models.Post()
+                post.dummy(site, site.owner)
+                post.save()
+                dirty_store.mark(site.uuid, planner.plan_post_created(
+                    post.uuid, site.owner.uuid, post.tags), COALESCE_WINDOW)
+            flush_site_updates(site.uuid)
+            posts = models.Post.select().where(models.Post.site == site)
+            archive_path = render.get_site_archive_path(site.uuid)
+            rendered = ""
+            for page in range(1, render.count_pages(posts.count()) + 1):
+                with open(os.path.join(archive_path, str(page) + ".html")) as page_file:
+                    rendered += page_file.read().decode("utf-8")
+            for post in posts:
+                self.assertIn(post.title, rendered)
+        finally:
+            render.STABLE_PAGINATION = False
+
+    def test_Edit_Post_Pins_Pages(self):
+        site = models.get_random_site()
+        initialize_site(site.uuid)
+        render.render_site(site.uuid)
+        post = models.get_random_post_from_site(site.uuid)
+        targets = planner.plan_post_edited(post.uuid, post.author.uuid, post.tags)
+        pages = find_post_pages(site.uuid, post, targets)
+        self.assertEqual(pages[(planner.ARCHIVE, False)], 1)
+        self.assertEqual(pages[(planner.USER, post.author.uuid, False)], 1)
+        post.title = "Retitled Post"
+        post.save()
+        edit_post(post.uuid)
+        page_path = os.path.join(render.get_site_archive_path(site.uuid), "1.html")
+        with open(page_path, "rb") as file_object:
+            self.assertIn("Retitled Post", file_object.read())
+
+    def plan_edit(self, post, **kwargs):
+        """Runs edit_post, returning the targets it dispatched."""
+        global dispatch_plan
+        dispatched = []
+        real_dispatch_plan = dispatch_plan
+        dispatch_plan = lambda uuid, targets, version=None: dispatched.append(targets)
+        try:
+            edit_post(post.uuid, **kwargs)
+        finally:
+            dispatch_plan = real_dispatch_plan
+        return dispatched[0]
+
+    def test_Edit_Post_New_Author(self):
+        site = models.get_random_site()
+        render.render_site(site.uuid)
+        post = models.get_random_post_from_site(site.uuid)
+        old_author = post.author
+        post.author = models.User.select().where(models.User.id != old_author.id).get()
+        post.save()
+        targets = self.plan_edit(post, old_author_uuid=old_author.uuid)
+        self.assertIn((planner.USER, old_author.uuid, False), targets)
+        self.assertIn((planner.USER, post.author.uuid, False), targets)
+        self.assertIn((planner.ARCHIVE, False, 1), targets)
+
+    def test_Edit_Untagged_Post(self):
+        site = models.get_random_site()
+        post = models.get_random_post_from_site(site.uuid)
+        post.tags = []
+        post.save()
+        render.render_site(site.uuid)
+        targets = self.plan_edit(post)
+        self.assertIn((planner.ARCHIVE, False, 1), targets)
+        self.assertIn((planner.USER, post.author.uuid, False, 1), targets)
+
     def test_Site_Change_Domain(self):
         site = models.get_random_site()
         initialize_site(site.uuid)
@@ -246,6 +783,121 @@ class TasksTest(unittest.TestCase):
         self.assertTrue( os.path.exists(another_new_domain_symlink_path ) )
 
 
+class RoutingTest(unittest.TestCase):
+
+    def test_Routes(self):
+        router = app.amqp.Router()
+        self.assertEqual(router.route({}, 'tasks.render_post')['queue'].name, INTERACTIVE_QUEUE)
+        self.assertEqual(router.route({}, 'tasks.full_rerender')['queue'].name, BULK_QUEUE)
+
+
+class CoalesceTest(unittest.TestCase):
+
+    def test_Memory_Dirty_Store(self):
+        store = MemoryDirtyStore()
+        self.assertTrue(store.mark("site", set([(planner.INDEX,)]), 5))
+        self.assertFalse(store.mark("site", set([(planner.RSS,), (planner.INDEX,)]), 5))
+        self.assertEqual(store.take("site"), set([(planner.INDEX,), (planner.RSS,)]))
+        self.assertEqual(store.take("site"), set())
+        self.assertTrue(store.mark("site", set([(planner.INDEX,)]), 5))
+
+
+class StopListening(Exception):
+    pass
+
+
+class StubPubSub(object):
+    """Delivers messages, then stops listen_for_site_changes."""
+
+    def __init__(self, messages):
+        self.messages = messages
+
+    def subscribe(self, channel):
+        pass
+
+    def listen(self):
+        for data in self.messages:
+            yield {'data': data}
+        raise StopListening()
+
+
+class StubRedis(object):
+
+    def __init__(self, messages=()):
+        self.messages = messages
+        self.published = []
+
+    def pubsub(self, **kwargs):
+        return StubPubSub(self.messages)
+
+    def publish(self, channel, message):
+        self.published.append(message)
+
+
+class SiteChangesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.redis_client = redis_client
+        self.invalidate_site = render.invalidate_site
+
+    def tearDown(self):
+        global redis_client
+        redis_client = self.redis_client
+        render.invalidate_site = self.invalidate_site
+
+    def test_Bad_Message(self):
+        global redis_client
+        invalidated = []
+        redis_client = StubRedis(["None", "", "7"])
+        render.invalidate_site = lambda site_id: invalidated.append(site_id)
+        self.assertRaises(StopListening, listen_for_site_changes)
+        self.assertEqual(invalidated, [7])
+
+    def test_Publish_Without_Site(self):
+        global redis_client
+        redis_client = StubRedis()
+        publish_site_change(models.Theme())
+        self.assertEqual(redis_client.published, [])
+
+
+class DedupTest(unittest.TestCase):
+
+    def setUp(self):
+        global dedup_store
+        dedup_store = MemoryDedupStore()
+
+    def test_Memory_Dedup_Store(self):
+        store = MemoryDedupStore()
+        self.assertTrue(store.claim("render_index:site", "v1", 60))
+        self.assertFalse(store.claim("render_index:site", "v1", 60))
+        store.complete("render_index:site", "v1", 60)
+        self.assertFalse(store.claim("render_index:site", "v1", 60))
+        self.assertTrue(store.claim("render_index:site", "v2", 60))
+        store.release("render_index:site", "v2")
+        self.assertTrue(store.claim("render_index:site", "v2", 60))
+
+    def test_Deduplicated(self):
+        calls = []
+
+        @deduplicated
+        def render_nothing(uuid):
+            calls.append(uuid)
+        render_nothing("site", version="v1")
+        render_nothing("site", version="v1")
+        render_nothing("other", version="v1")
+        render_nothing("site", version="v2")
+        render_nothing("site")
+        render_nothing("site")
+        self.assertEqual(calls, ["site", "other", "site", "site", "site"])
+
+    def test_Failure_Releases_Claim(self):
+        @deduplicated
+        def render_broken(uuid):
+            raise IOError(uuid)
+        self.assertRaises(IOError, render_broken, "site", version="v1")
+        self.assertRaises(IOError, render_broken, "site", version="v1")
+
+
 for i in range(5):
     user = models.create_dummy_user()
     user.save()
@@ -1,11 +1,16 @@
 import os
+from passlib.context import CryptContext
+from passlib.hash import bcrypt
 from peewee import *
 import shutil
 import unittest
 
 
-from models import db, Site, User
+from models import db, Post, PostTag, RecyclingPooledMySQLDatabase, Site, Theme, User
 from models import create_dummy_user, create_dummy_site
+from models import get_post_tags, get_site_tag_counts, get_site_tags, set_post_tags
+from models import load_dummy_data, load_dummy_sites, load_dummy_users
+import models
 import utilities
 
 
@@ -18,10 +23,14 @@ import utilities
 
 def prepDB():
   cleanDB()
-  db.create_tables([Site, User])
+  db.create_tables([Site, User, Theme, Post, PostTag])
 
 
 def cleanDB():
+  try:
+    db.drop_tables([PostTag, Post, Theme])
+  except OperationalError:
+    pass
   try:
     db.drop_tables([Site])
   except OperationalError:
@@ -34,6 +43,78 @@ def cleanDB():
     #utilities.logger.debug('User table did non exists')
 
 
+####################################################
+# Connection Pool
+####################################################
+class StubConnection(object):
+  """Stands in for a MySQLdb connection, whose open flag stays set after
+  the server drops it; only ping() notices."""
+
+  def __init__(self):
+    self.open = True
+    self.alive = True
+    self.closed = False
+
+  def ping(self, *args):
+    if not self.alive:
+      raise OperationalError("MySQL server has gone away")
+
+  def close(self):
+    self.open = False
+    self.closed = True
+
+
+class StubMySQLDatabase(MySQLDatabase):
+
+  def _connect(self, database, **kwargs):
+    return StubConnection()
+
+
+class StubPool(RecyclingPooledMySQLDatabase, StubMySQLDatabase):
+  pass
+
+
+class RecyclingPoolTest(unittest.TestCase):
+
+  def setUp(self):
+    self.pool = StubPool("muckamuck", max_uses=2)
+
+  def checkout(self):
+    self.pool.connect()
+    conn = self.pool.get_conn()
+    self.pool.close()
+    return conn
+
+  def test_Reuse_Connection(self):
+    self.assertIs(self.checkout(), self.checkout())
+
+  def test_Drop_Dead_Connection(self):
+    first = self.checkout()
+    first.alive = False
+    second = self.checkout()
+    self.assertIsNot(first, second)
+    self.assertTrue(first.closed)
+
+  def test_Retire_After_Max_Uses(self):
+    first = self.checkout()
+    self.assertIs(self.checkout(), first)
+    third = self.checkout()
+    self.assertIsNot(third, first)
+    self.assertTrue(first.closed)
+    self.assertFalse(third.closed)
+
+  def test_Reset_After_Fork(self):
+    pooled = self.checkout()
+    self.pool.connect()
+    held = self.pool.get_conn()
+    self.pool.reset_after_fork()
+    self.assertFalse(pooled.closed)
+    self.assertFalse(held.closed)
+    self.assertTrue(self.pool.is_closed())
+    fresh = self.checkout()
+    self.assertNotIn(fresh, (pooled, held))
+
+
 ####################################################
 # Site Model
 ####################################################
@@ -69,6 +150,92 @@ class SiteTest(unittest.TestCase):
     #shutil.rmtree(site.get_site_dir_path())
 
 
+####################################################
+# Tag Index
+####################################################
+class PostTagTest(unittest.TestCase):
+
+  def setUp(self):
+    db.connect()
+    prepDB()
+
+  def tearDown(self):
+    cleanDB()
+    db.close()
+
+  def create_post(self, site, tags):
+    post = Post()
+    post.dummy(site, site.owner)
+    post.tags = tags
+    post.save()
+    return post
+
+  def test_Site_Tags(self):
+    site = create_dummy_site()
+    site.save()
+    self.create_post(site, ["a", "b"])
+    self.create_post(site, ["b"])
+    self.assertEqual(get_site_tags(site.uuid), set(["a", "b"]))
+    self.assertEqual(get_site_tag_counts(site.uuid), {"a": 1, "b": 2})
+
+  def test_Retag_Post(self):
+    site = create_dummy_site()
+    site.save()
+    post = self.create_post(site, ["a", "b"])
+    post.tags = ["c"]
+    post.save()
+    self.assertEqual(get_post_tags(post), set(["c"]))
+
+  def test_Delete_Post(self):
+    site = create_dummy_site()
+    site.save()
+    post = self.create_post(site, ["a"])
+    post.delete_instance()
+    self.assertEqual(get_post_tags(post), set())
+    self.assertEqual(get_site_tags(site.uuid), set())
+
+  def test_Set_Post_Tags(self):
+    site = create_dummy_site()
+    site.save()
+    post = self.create_post(site, ["a"])
+    PostTag.delete().execute()
+    set_post_tags(post)
+    self.assertEqual(get_post_tags(post), set(["a"]))
+
+
+class BulkFixtureTest(unittest.TestCase):
+
+  def setUp(self):
+    db.connect()
+    prepDB()
+
+  def tearDown(self):
+    cleanDB()
+    db.close()
+
+  def test_Load_Users_And_Sites(self):
+    user_ids = load_dummy_users(5, password_hash="hash")
+    sites = load_dummy_sites(user_ids, sites_per_owner=2)
+    self.assertEqual(User.select().count(), 5)
+    self.assertEqual(Site.select().count(), 10)
+    self.assertEqual(User.select().where(User.password == "hash").count(), 5)
+    site = Site.get(Site.id == sites[-1][0])
+    self.assertEqual(site.owner.id, user_ids[-1])
+
+  def test_Load_Platform(self):
+    sites = load_dummy_data(users=2, sites_per_user=2, posts_per_site=3)
+    self.assertEqual(Theme.select().count(), 4)
+    self.assertEqual(Post.select().count(), 12)
+    post = Post.select().where(Post.site == sites[0][0]).get()
+    self.assertEqual(post.author.id, sites[0][1])
+    self.assertEqual(get_post_tags(post), set(post.tags))
+
+  def test_Load_Users_Twice(self):
+    load_dummy_users(3)
+    load_dummy_users(3)
+    self.assertEqual(User.select().count(), 6)
+
+
 ####################################################
 # User Model
 ####################################################
@@ -148,6 +315,30 @@ class UserTest(unittest.TestCase):
     user.save()
     self.assertFalse(user.verify_password(user_BADpassword))
 
+  def test_User_Password_Rehash(self):
+    user_password = utilities.fake.password()
+    user = create_dummy_user()
+    user.password = bcrypt.encrypt(user_password, rounds=4)
+    user.save()
+    password_context = models.password_context
+    models.password_context = CryptContext(
+      schemes=["bcrypt"], bcrypt__default_rounds=5, bcrypt__min_rounds=5)
+    try:
+      self.assertTrue(user.verify_password(user_password))
+    finally:
+      models.password_context = password_context
+    saved = User.get(User.id == user.id)
+    self.assertEqual(bcrypt.from_string(saved.password).rounds, 5)
+    self.assertTrue(saved.verify_password(user_password))
+
+  def test_User_Password_Async(self):
+    user_password = utilities.fake.password()
+    user = create_dummy_user()
+    user.encrypt_password(user_password)
+    user.save()
+    self.assertTrue(user.verify_password_async(user_password).get(30))
+    self.assertFalse(user.verify_password_async("wrong").get(30))
+
   def test_User_Json_File(self):
     user = create_dummy_user()
     user.save()